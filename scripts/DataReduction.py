@@ -1,36 +1,29 @@
-import numpy, codecs, itertools, math
-import simplejson as json
-import sys
-from datetime import *
+import numpy, codecs, itertools, math, bisect
+import os, sys
+import multiprocessing
+from cache import Cache
 from clustering import Clustering
+from metadata import Metadata
 from metrics import completeness, homogeneity
 
-time_threshold = sys.argv[1]
-fileID = sys.argv[2]
-fileREF = sys.argv[3]
-fileOUT = sys.argv[4]
-
 # python DataReduction.py 3600 ../Dev_dataset/SED_2014_Dev_A_Pictures.txt ../Dev_dataset/SED_2014_Dev_A_Ref_task1.txt results_Dev_A_1h.txt
 
-def readjson(jsonFile):
-	dictionary=None
-	with codecs.open(jsonFile, "rt", encoding="utf8") as fic:
-		data = [json.loads(line) for line in fic]
-		dictionary = {obj['photoID']: obj for obj in data}
-	return dictionary
+# sweep mode: comma-separated thresholds, one output file per threshold
+# ({alpha} in output file name is replaced by the threshold)
+# python DataReduction.py 3600,36000,72000,86400,108000,360000 ../Dev_dataset/SED_2014_Dev_A_Pictures.txt ../Dev_dataset/SED_2014_Dev_A_Ref_task1.txt results_Dev_A_{alpha}.txt
 
-def clusterUser(dictionary, listID):
+def clusterUser(metadata, listID):
 	with codecs.open(listID, "rt", encoding='utf8') as fic:
 		imgs = [int(line.strip()) for line in fic]
+	users = metadata.username[metadata.index(imgs)].tolist()
 
 	cluster = {}
 	cluster_id = {}
 	clusterId = 0
 
-	matrix = numpy.eye(len(imgs), dtype=int)
 	for i in range (0, len(imgs)):
 		img_i = imgs[i]
-		userI = dictionary[img_i]['username']
+		userI = users[i]
 		if userI not in cluster_id:
 			cluster_id[userI] = clusterId
 			clusterId = clusterId+1
@@ -42,52 +35,87 @@ def clusterUser(dictionary, listID):
 
 	return new_cluster
 
-def clusterDate(dictionary, listID, clusterU):
+def userTimelines(metadata, listID, clusterU):
+	# one (pictures, dates) timeline per user, sorted by date
 	with codecs.open(listID, "rt", encoding='utf8') as fic:
 		imgs = [int(line.strip()) for line in fic]
+	dates = metadata.dateTaken[metadata.index(imgs)].tolist()
+	date = dict(zip(imgs, dates))
 
-	cluster = {}
-	date = {}
-
-	matrix = numpy.eye(len(imgs), dtype=int)
-	for i in range (0, len(imgs)):
-		img_i = imgs[i]
-		dateI = datetime.strptime(dictionary[img_i]['dateTaken'], "%Y-%m-%d %H:%M:%S")
-		date[img_i] = dateI
-
-	clusterId = 0
-	
-
+	timelines = []
 	for c in clusterU.values():
-		noyau = {}
-		cluster_prov = {}
-		noyau[clusterId] = date[c[0]]
-		cluster_prov[c[0]] = clusterId
-		for i in range (1, len(c)):
-			img = c[i]
-			dateI = date[img]
-			min = 100000000000000000
-			k = -1
-
-			for k, d in noyau.iteritems():
-				diff = d-dateI
-				diff_seconds = abs(diff.total_seconds())
-				if min > diff_seconds:
-					min = diff_seconds
-					indice = k
-			if min < int(time_threshold): #10800
-				mean = noyau[indice] + timedelta(seconds=(min / 2))
-				noyau[indice] = mean
-				cluster_prov[c[i]] = indice
+		c = sorted(c, key=date.__getitem__)
+		timelines.append((c, [date[img] for img in c]))
+	return timelines
+
+def sweepTimeline(imgs, dates, time_threshold, clusterId=0):
+	# split one user timeline, visiting pictures in the given order: each
+	# picture joins the cluster whose time core is the closest (if closer
+	# than threshold), or starts a new cluster with id clusterId + 1.
+	# the first picture joins cluster clusterId.
+	# returns {picture: cluster id} and the last cluster id
+	threshold = int(time_threshold) #10800
+
+	noyau = {clusterId: dates[0]}
+	# time cores, sorted, so that the closest one is found by bisection
+	cores = [(dates[0], clusterId)]
+	cluster_prov = {imgs[0]: clusterId}
+
+	for img, dateI in itertools.izip(imgs[1:], dates[1:]):
+		i = bisect.bisect_left(cores, (dateI, ))
+		diff = float('inf')
+		if i > 0:
+			diff = dateI - cores[i - 1][0]
+		if i < len(cores):
+			diff = min(diff, cores[i][0] - dateI)
+
+		if diff < threshold:
+			# all time cores at that distance
+			tied = []
+			j = i - 1
+			while j >= 0 and dateI - cores[j][0] == diff:
+				tied.append(cores[j][1])
+				j = j - 1
+			j = i
+			while j < len(cores) and cores[j][0] - dateI == diff:
+				tied.append(cores[j][1])
+				j = j + 1
+			if len(tied) == 1:
+				indice = tied[0]
 			else:
-			    clusterId = clusterId + 1
-			    noyau[clusterId] = dateI
-			    cluster_prov[c[i]] = clusterId
+				# first one in dict order, as before
+				indice = next(k for k in noyau if k in tied)
+			# time core moves forward by half the distance
+			core = (noyau[indice], indice)
+			del cores[bisect.bisect_left(cores, core)]
+			noyau[indice] = noyau[indice] + diff / 2.
+			bisect.insort(cores, (noyau[indice], indice))
+			cluster_prov[img] = indice
+		else:
+			clusterId = clusterId + 1
+			noyau[clusterId] = dateI
+			bisect.insort(cores, (dateI, clusterId))
+			cluster_prov[img] = clusterId
+
+	return cluster_prov, clusterId
+
+def sweepTimelines(timelines, time_threshold):
+	cluster = {}
+	clusterId = -1
+
+	for imgs, dates in timelines:
+		# clusters of different users never share an id
+		cluster_prov, clusterId = sweepTimeline(imgs, dates, time_threshold,
+		                                        clusterId=clusterId + 1)
 		for k, v in cluster_prov.iteritems():
 			cluster.setdefault(v, []).append(k)
 
 	return cluster
 
+def clusterDate(metadata, listID, clusterU, time_threshold):
+	timelines = userTimelines(metadata, listID, clusterU)
+	return sweepTimelines(timelines, time_threshold)
+
 def print_result_file(cluster, filename):
 	file = open(filename, "w")
 
@@ -97,25 +125,105 @@ def print_result_file(cluster, filename):
 
 	file.close()
 
-print "Loading json into memory..."
-dictionary = readjson("/vol/corpora4/mediaeval/2014/SED_2014_Dev_Metadata.json")
-print "...Done !"
-
-clusterU = clusterUser(dictionary, fileID)
-clusterD = clusterDate(dictionary, fileID, clusterU)
-
-print_result_file(clusterD, fileOUT)
-
-reference = Clustering.load(fileREF)
-hypothesis = Clustering.load(fileOUT)
-
-images = []
-for c in clusterD.values():
-	for i in range (0, len(c)):
-		images.append(c[i])
-
-h = homogeneity(reference, hypothesis, images)
-print h
-c = completeness(reference, hypothesis, images)
-print c
+def evaluate(cluster, reference):
+	hypothesis = Clustering()
+	images = []
+	for k, v in cluster.iteritems():
+		for photo in v:
+			hypothesis[photo] = k
+			images.append(photo)
+	h = homogeneity(reference, hypothesis, images)
+	c = completeness(reference, hypothesis, images)
+	return h, c
+
+def outputFile(fileOUT, time_threshold):
+	if '{alpha}' in fileOUT:
+		return fileOUT.format(alpha=time_threshold)
+	root, ext = os.path.splitext(fileOUT)
+	return '%s_%s%s' % (root, time_threshold, ext)
+
+def load_result_file(filename):
+	cluster = {}
+	for photo, k in Clustering.load(filename).iteritems():
+		cluster.setdefault(k, []).append(photo)
+	return cluster
 
+# shared with forked worker processes in sweep mode
+timelines = None
+reference = None
+
+def sweepOne(args):
+	time_threshold, filename = args
+	clusterD = sweepTimelines(timelines, time_threshold)
+	print_result_file(clusterD, filename)
+	h, c = evaluate(clusterD, reference)
+	return time_threshold, len(clusterD), h, c
+
+def cachedOne(args):
+	# result file copied from the cache, only evaluation is left
+	time_threshold, filename = args
+	clusterD = load_result_file(filename)
+	h, c = evaluate(clusterD, reference)
+	return time_threshold, len(clusterD), h, c
+
+if __name__ == '__main__':
+
+	time_thresholds = sys.argv[1].split(',')
+	fileID = sys.argv[2]
+	fileREF = sys.argv[3]
+	fileOUT = sys.argv[4]
+
+	metadata = Metadata("/vol/corpora4/mediaeval/2014/SED_2014_Dev_Metadata")
+
+	if len(time_thresholds) == 1 and '{alpha}' not in fileOUT:
+		jobs = [(time_thresholds[0], fileOUT)]
+	else:
+		jobs = [(time_threshold, outputFile(fileOUT, time_threshold))
+		        for time_threshold in time_thresholds]
+
+	# one cache entry per threshold
+	cache = Cache()
+	keys, hits = {}, set()
+	if cache.enabled:
+		if not os.path.isdir(cache.root):
+			os.makedirs(cache.root)
+		for time_threshold, filename in jobs:
+			keys[time_threshold] = cache.key(__file__, [fileID, metadata.path],
+			                                 {'alpha': int(time_threshold)})
+			if cache.fetch(keys[time_threshold], [filename]):
+				hits.add(time_threshold)
+	todo = [job for job in jobs if job[0] not in hits]
+
+	# group by user and sort each user timeline once for all thresholds
+	# (only when some of them are not cached)
+	if todo:
+		clusterU = clusterUser(metadata, fileID)
+		timelines = userTimelines(metadata, fileID, clusterU)
+
+	reference = Clustering.load(fileREF)
+
+	if len(jobs) == 1:
+		if todo:
+			_, _, h, c = sweepOne(jobs[0])
+		else:
+			_, _, h, c = cachedOne(jobs[0])
+		print h
+		print c
+	else:
+		pool = multiprocessing.Pool(min(len(jobs), multiprocessing.cpu_count()))
+		computed = pool.map_async(sweepOne, todo)
+		cached = pool.map_async(cachedOne, [j for j in jobs if j[0] in hits])
+		results = computed.get() + cached.get()
+		pool.close()
+		pool.join()
+
+		order = [time_threshold for time_threshold, _ in jobs]
+		results = sorted(results, key=lambda r: order.index(r[0]))
+
+		print "alpha\tclusters\thomogeneity\tcompleteness"
+		for time_threshold, nClusters, h, c in results:
+			print "%s\t%d\t%.4f\t%.4f" % (time_threshold, nClusters, h, c)
+
+	if cache.enabled:
+		for time_threshold, filename in todo:
+			cache.store(keys[time_threshold], [filename])
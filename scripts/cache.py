@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License (MIT)
+
+# Copyright (c) 2014 Hervé BREDIN
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Content-addressed cache of intermediate pipeline outputs
+
+Outputs of a script (files or directories) are stored under a key that is the
+SHA-1 of the script source (and of the local modules it imports), the
+contents of its input files (or directories) and its parameters. When a script
+is run again with the same inputs and parameters, its outputs are copied from
+the cache instead of being recomputed.
+
+The cache is enabled by setting the BYZANCE_CACHE environment variable to a
+(local) directory. Its size is bounded by BYZANCE_CACHE_SIZE (in bytes, with
+optional K, M, G or T suffix, 10G by default): least recently used entries
+are evicted first.
+
+>>> cache = Cache()
+>>> cache.run(__file__, [reference_txt, clustering_txt], {'upper': True},
+...           [groundtruth_npy], do_compute, reference_txt, ...)
+
+Usage:
+  cache.py info
+  cache.py evict
+  cache.py clear
+  cache.py (-h | --help)
+  cache.py --version
+
+Options:
+  -h --help     Show this screen.
+  --version     Show version.
+
+"""
+
+from docopt import docopt
+import simplejson as json
+import hashlib
+import shutil
+import time
+import sys
+import os
+
+
+DEFAULT_SIZE = '10G'
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+# files are hashed by chunks of this size
+CHUNK = 1 << 20
+
+
+def parse_size(size):
+    """'10G' --> 10737418240"""
+    size = str(size).strip().upper()
+    if size and size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def _walk(path):
+    """Files of a directory (relative paths, sorted)"""
+    files = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            files.append(os.path.relpath(os.path.join(root, name), path))
+    return sorted(files)
+
+
+def _local_modules(script):
+    """Sources of modules imported from the directory of script (sorted)"""
+    directory = os.path.dirname(os.path.realpath(script))
+    sources = set()
+    for module in sys.modules.values():
+        path = getattr(module, '__file__', None)
+        if path is None:
+            continue
+        path = os.path.splitext(os.path.realpath(path))[0] + '.py'
+        if os.path.dirname(path) == directory and os.path.exists(path):
+            sources.add(path)
+    sources.discard(os.path.splitext(os.path.realpath(script))[0] + '.py')
+    return sorted(sources)
+
+
+def _size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f))
+                   for f in _walk(path))
+    return os.path.getsize(path)
+
+
+def _copy(source, target):
+    # copy (and not link) so that overwriting an output in place
+    # never corrupts the cache
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    if os.path.isdir(source):
+        shutil.copytree(source, target)
+    else:
+        shutil.copyfile(source, target)
+
+
+class Cache(object):
+    """Content-addressed cache
+
+    Parameters
+    ----------
+    root : str, optional
+        Cache directory. Defaults to $BYZANCE_CACHE. When neither is set,
+        the cache is disabled (and run() always computes).
+    max_size : int or str, optional
+        Maximum cache size in bytes (e.g. '500M').
+        Defaults to $BYZANCE_CACHE_SIZE, or 10G.
+    """
+
+    def __init__(self, root=None, max_size=None):
+        super(Cache, self).__init__()
+
+        if root is None:
+            root = os.environ.get('BYZANCE_CACHE')
+        self.root = root
+
+        if max_size is None:
+            max_size = os.environ.get('BYZANCE_CACHE_SIZE', DEFAULT_SIZE)
+        self.max_size = parse_size(max_size)
+
+        # file digests, indexed by (path, size, modification time)
+        self._digests = None
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+    def _path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def _load_digests(self):
+        if self._digests is None:
+            self._digests = {}
+            path = self._path('digests.json')
+            if os.path.exists(path):
+                try:
+                    with open(path, 'r') as f:
+                        self._digests = json.load(f)
+                except ValueError:
+                    pass
+        return self._digests
+
+    def _save_digests(self):
+        path = self._path('digests.json')
+        temporary = '%s.%d' % (path, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(self._digests, f)
+        os.rename(temporary, path)
+
+    def digest(self, path):
+        """SHA-1 of file (or directory) contents
+
+        File digests are remembered as long as their size and modification
+        time do not change.
+        """
+
+        if os.path.isdir(path):
+            sha1 = hashlib.sha1()
+            for name in _walk(path):
+                sha1.update(name.encode('utf8') + '\0')
+                sha1.update(self.digest(os.path.join(path, name)))
+            return sha1.hexdigest()
+
+        digests = self._load_digests()
+        stat = os.stat(path)
+        signature = '%s:%d:%f' % (os.path.realpath(path),
+                                  stat.st_size, stat.st_mtime)
+        if signature not in digests:
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK), ''):
+                    sha1.update(chunk)
+            digests[signature] = sha1.hexdigest()
+            self._save_digests()
+        return digests[signature]
+
+    def key(self, script, inputs=(), params=None):
+        """Cache key of a script run
+
+        Parameters
+        ----------
+        script : str
+            Path to script. Its source, and the source of every module it
+            imported from the same directory, are part of the key.
+        inputs : list of str
+            Input files or directories (None entries are ignored).
+        params : dict, optional
+            Parameters (their repr() is part of the key).
+        """
+        sha1 = hashlib.sha1()
+        sha1.update(os.path.basename(script).encode('utf8') + '\0')
+        sha1.update(self.digest(script))
+        for path in _local_modules(script):
+            sha1.update(os.path.basename(path).encode('utf8') + '\0')
+            sha1.update(self.digest(path))
+        for path in inputs:
+            sha1.update('\0' if path is None else self.digest(path))
+        for name, value in sorted((params or {}).items()):
+            sha1.update('\0%s=%r' % (name, value))
+        return sha1.hexdigest()
+
+    def _entry(self, key):
+        return self._path(key[:2], key)
+
+    def fetch(self, key, outputs):
+        """Copy cached outputs. Returns False in case of cache miss."""
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return False
+        cached = [os.path.join(entry, str(i)) for i in range(len(outputs))]
+        if not all(os.path.exists(c) for c in cached):
+            return False
+        for source, target in zip(cached, outputs):
+            _copy(source, target)
+        # mark entry as recently used
+        os.utime(entry, None)
+        return True
+
+    def store(self, key, outputs):
+        """Add outputs to the cache (and evict old entries if needed)"""
+        entry = self._entry(key)
+        temporary = '%s.%d.tmp' % (entry, os.getpid())
+        if os.path.isdir(temporary):
+            shutil.rmtree(temporary)
+        os.makedirs(temporary)
+        for i, output in enumerate(outputs):
+            _copy(output, os.path.join(temporary, str(i)))
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.rename(temporary, entry)
+        self.evict()
+
+    def entries(self):
+        """(last use, size, path) of every entry, least recently used first"""
+        entries = []
+        if not self.enabled or not os.path.isdir(self.root):
+            return entries
+        for prefix in os.listdir(self.root):
+            directory = self._path(prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                entry = os.path.join(directory, name)
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    entries.append((os.path.getmtime(entry),
+                                    _size(entry), entry))
+                except OSError:
+                    # evicted by another process
+                    continue
+        return sorted(entries)
+
+    def evict(self):
+        """Remove least recently used entries until cache fits max_size"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def run(self, script, inputs, params, outputs, function, *args, **kwargs):
+        """Run function(*args, **kwargs) unless its outputs are cached
+
+        Parameters
+        ----------
+        script : str
+            Path to script (usually __file__).
+        inputs : list of str
+            Input files or directories.
+        params : dict
+            Parameters.
+        outputs : list of str
+            Output files or directories written by function.
+
+        Returns
+        -------
+        hit : bool
+            True if outputs were copied from the cache.
+        """
+
+        if not self.enabled:
+            function(*args, **kwargs)
+            return False
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        key = self.key(script, inputs, params)
+        if self.fetch(key, outputs):
+            return True
+
+        function(*args, **kwargs)
+        # function may have failed without raising
+        if all(os.path.exists(output) for output in outputs):
+            self.store(key, outputs)
+        return False
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    cache = Cache()
+    if not cache.enabled:
+        raise SystemExit('BYZANCE_CACHE is not set.')
+
+    if arguments['info']:
+        entries = cache.entries()
+        total = sum(size for _, size, _ in entries)
+        print '{root}: {n} entries, {size:.1f}M / {max_size:.1f}M'.format(
+            root=cache.root, n=len(entries), size=total / 1024. ** 2,
+            max_size=cache.max_size / 1024. ** 2)
+        for last, size, entry in reversed(entries):
+            print '{last}  {size:10.1f}K  {key}'.format(
+                last=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last)),
+                size=size / 1024., key=os.path.basename(entry))
+
+    if arguments['evict']:
+        cache.evict()
+
+    if arguments['clear']:
+        cache.clear()
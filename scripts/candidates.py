@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License (MIT)
+
+# Copyright (c) 2014 Hervé BREDIN
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Generate candidate pairs of clusters close in time
+
+The time interval of a cluster goes from the first to the last date taken of
+its images. Two clusters are candidates when the gap between their time
+intervals is at most <window> hours (the paper prevents the merging of
+clusters more than 48h apart). Candidate pairs are found by sweeping over
+clusters sorted by start date, in O(K log K + number of pairs).
+
+The output is a sparse symmetric K x K matrix (.npz, in sorted cluster
+order) whose stored entries are the candidate pairs (and their time gap, in
+seconds). It can be passed with --pairs to geo.py, text.py,
+cluster_distance.py and groundtruth.py so that only candidate pairs are
+compared.
+
+Usage:
+  candidates.py [--window=<hours>] <metadata.dir> <clustering.txt> <pairs.npz>
+  candidates.py (-h | --help)
+  candidates.py --version
+
+Options:
+  --window=<hours>  Maximum time gap between clusters [default: 48].
+  -h --help         Show this screen.
+  --version         Show version.
+
+"""
+
+from docopt import docopt
+from cache import Cache
+from clustering import CompactClustering
+from matrix import save_matrix
+from metadata import Metadata
+import scipy.sparse
+import numpy as np
+
+
+def time_intervals(dates, codes, n_clusters):
+    """First and last date of every cluster
+
+    Parameters
+    ----------
+    dates : numpy array
+        Date (in seconds) of every image (or first and last dates of
+        sub-clusters).
+    codes : numpy array
+        codes[i] is the index of the cluster containing image i.
+    n_clusters : int
+
+    Returns
+    -------
+    start, end : (n_clusters, ) numpy arrays
+        Empty clusters have an empty interval (start = +inf, end = -inf).
+    """
+    start = np.inf * np.ones((n_clusters, ))
+    end = -np.inf * np.ones((n_clusters, ))
+    np.minimum.at(start, codes, dates)
+    np.maximum.at(end, codes, dates)
+    return start, end
+
+
+def cluster_intervals(metadata, clustering):
+    """Time interval of every cluster (in sorted cluster order)
+
+    Parameters
+    ----------
+    metadata : Metadata
+    clustering : CompactClustering
+
+    Returns
+    -------
+    start, end : numpy arrays
+    """
+    clusters = sorted(clustering.clusters)
+    index = {cluster: c for c, cluster in enumerate(clusters)}
+    images = list(clustering)
+    codes = np.array([index[c] for c in clustering.to_list(images)],
+                     dtype=np.int64)
+    dates = metadata.dateTaken[metadata.index(images)]
+    return time_intervals(dates, codes, len(clusters))
+
+
+def time_gap(start, end, rows, cols):
+    """Time gap between intervals of clusters rows[k] and cols[k]"""
+    return np.maximum(0., np.maximum(start[cols] - end[rows],
+                                     start[rows] - end[cols]))
+
+
+def time_window_pairs(start, end, window):
+    """Pairs of clusters whose time intervals are at most `window` apart
+
+    Clusters are sorted by start date so that, for each cluster, candidates
+    are the clusters starting between its own start and its end + window.
+
+    Returns
+    -------
+    rows, cols : numpy arrays
+        Each unordered pair (rows[k] < cols[k]) is returned once.
+    """
+
+    order = np.argsort(start, kind='mergesort')
+    sorted_start = start[order]
+
+    # candidates of order[i] are order[i + 1:last[i]]
+    last = np.searchsorted(sorted_start, end[order] + window, side='right')
+    count = np.maximum(0, last - np.arange(1, len(order) + 1))
+
+    i = np.repeat(np.arange(len(order)), count)
+    offset = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count,
+                                                  count)
+    j = i + 1 + offset
+
+    rows, cols = order[i], order[j]
+    return np.minimum(rows, cols), np.maximum(rows, cols)
+
+
+def candidate_pairs(start, end, window):
+    """Sparse symmetric matrix of candidate pairs (and their time gap)"""
+    K = len(start)
+    rows, cols = time_window_pairs(start, end, window)
+    gap = time_gap(start, end, rows, cols)
+    # explicit construction so that zero gaps are kept
+    return scipy.sparse.coo_matrix(
+        (np.hstack([gap, gap]),
+         (np.hstack([rows, cols]), np.hstack([cols, rows]))),
+        shape=(K, K)).tocsr()
+
+
+def upper_pairs(pairs):
+    """Pairs (rows[k] < cols[k]) stored in (symmetric) sparse matrix"""
+    pairs = pairs.tocoo()
+    upper = pairs.row < pairs.col
+    return (pairs.row[upper].astype(np.int64),
+            pairs.col[upper].astype(np.int64))
+
+
+def restrict(matrix, pairs, diagonal=True):
+    """Only keep entries of sparse `matrix` that are stored in `pairs`
+
+    Parameters
+    ----------
+    matrix, pairs : scipy sparse matrices
+    diagonal : bool, optional
+        Keep diagonal entries as well. Defaults to True.
+    """
+    matrix = matrix.tocoo()
+    pairs = pairs.tocoo()
+    K = matrix.shape[1]
+    keep = np.in1d(matrix.row.astype(np.int64) * K + matrix.col,
+                   pairs.row.astype(np.int64) * K + pairs.col)
+    if diagonal:
+        keep |= matrix.row == matrix.col
+    return scipy.sparse.coo_matrix(
+        (matrix.data[keep], (matrix.row[keep], matrix.col[keep])),
+        shape=matrix.shape).tocsr()
+
+
+def within_window(matrix, start, end, window):
+    """Sparse matrix without entries between clusters too far apart in time"""
+    matrix = matrix.tocoo()
+    keep = time_gap(start, end, matrix.row, matrix.col) <= window
+    return scipy.sparse.coo_matrix(
+        (matrix.data[keep], (matrix.row[keep], matrix.col[keep])),
+        shape=matrix.shape).tocsr()
+
+
+def do_it(metadata_dir, clustering_txt, pairs_npz, window=48):
+
+    metadata = Metadata(metadata_dir)
+
+    # load hypothesis clusters
+    clustering = CompactClustering.load(clustering_txt)
+
+    start, end = cluster_intervals(metadata, clustering)
+    pairs = candidate_pairs(start, end, 3600. * window)
+
+    save_matrix(pairs_npz, pairs)
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    metadata_dir = arguments['<metadata.dir>']
+    clustering_txt = arguments['<clustering.txt>']
+    pairs_npz = arguments['<pairs.npz>']
+    window = float(arguments['--window'])
+
+    Cache().run(__file__, [metadata_dir, clustering_txt], {'window': window},
+                [pairs_npz], do_it, metadata_dir, clustering_txt, pairs_npz,
+                window=window)
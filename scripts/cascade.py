@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License (MIT)
+
+# Copyright (c) 2014 Hervé BREDIN
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Cascaded geographic then textual hierarchical clustering
+
+Pre-clusters are first merged by single-linkage clustering on geographic
+distance (see geo.py) at <theta_geo> km, then the resulting clusters are
+merged by single-linkage clustering on textual distance (see text.py) at
+<theta_text>.
+
+Two clusters are only compared when the gap between their time intervals
+(from first to last date taken) is at most --window hours: the paper
+prevents the merging of clusters more than 48h apart. In the textual stage,
+this is used as a prefilter so that only distances between candidate pairs
+of clusters are computed and the K x K matrix is never materialized.
+
+Term counts are computed once for all, for every pre-cluster. Those of the
+clusters of the geographic stage are obtained by summing the term counts of
+their pre-clusters, and BM25 weighting is then applied.
+
+Usage:
+  cascade.py [--metadata=<dir>] [--window=<hours>] [--fields=<fields>] [--geo=<geo.txt>] <pre_clustering.txt> <theta_geo> <theta_text> <output.txt>
+  cascade.py (-h | --help)
+  cascade.py --version
+
+Options:
+  --metadata=<dir>   Metadata directory (see metadata.py)
+                     [default: /vol/corpora4/mediaeval/2014/SED_2014_Dev_Metadata].
+  --window=<hours>   Only compare clusters closer in time [default: 48].
+  --fields=<fields>  Comma-separated metadata fields [default: title,description,tags].
+  --geo=<geo.txt>    Also save output of geographic stage.
+  -h --help          Show this screen.
+  --version          Show version.
+
+"""
+
+from docopt import docopt
+from candidates import time_intervals, candidate_pairs, within_window
+from clustering import CompactClustering
+from metadata import Metadata
+from geo import GeoIndex
+from text import term_counts, bm25, cosine_distance
+import hac
+import scipy.sparse
+import numpy as np
+
+
+def _codes(clustering):
+    """Images and index of their cluster (in sorted cluster order)"""
+    clusters = sorted(clustering.clusters)
+    index = {cluster: c for c, cluster in enumerate(clusters)}
+    images = list(clustering)
+    codes = np.array([index[c] for c in clustering.to_list(images)],
+                     dtype=np.int64)
+    return images, codes, len(clusters)
+
+
+def do_it(pre_clustering_txt, theta_geo, theta_text, output_txt,
+          metadata_dir, window=48, fields=('title', 'description', 'tags'),
+          geo_txt=None):
+
+    metadata = Metadata(metadata_dir)
+    window = 3600. * window
+
+    # load pre-clusters
+    pre_clustering = CompactClustering.load(pre_clustering_txt)
+    images, codes, K = _codes(pre_clustering)
+    rows = metadata.index(images)
+
+    # time interval of pre-clusters
+    start, end = time_intervals(metadata.dateTaken[rows], codes, K)
+
+    # == geographic stage ==
+
+    # pairs further than theta_geo would not be merged anyway
+    geo = GeoIndex(metadata.latitude[rows], metadata.longitude[rows], codes,
+                   n_clusters=K)
+    distance = within_window(geo.sparse_distance(theta_geo),
+                             start, end, window)
+    geo_clustering = CompactClustering(
+        hac.cluster(pre_clustering, distance, theta_geo))
+    if geo_txt is not None:
+        geo_clustering.save(geo_txt)
+
+    # == textual stage ==
+
+    # geographic cluster of every pre-cluster (in sorted order)
+    preClusters = sorted(pre_clustering.clusters)
+    geoClusters = sorted(geo_clustering.clusters)
+    index = {cluster: c for c, cluster in enumerate(geoClusters)}
+    merged = np.array(
+        [index[geo_clustering[pre_clustering.clusters[cluster][0]]]
+         for cluster in preClusters], dtype=np.int64)
+    G = len(geoClusters)
+
+    # term counts of pre-clusters, summed into their geographic cluster
+    counts, _ = term_counts(metadata, rows, codes, K, fields=fields)
+    aggregate = scipy.sparse.coo_matrix(
+        (np.ones((K, )), (merged, np.arange(K))), shape=(G, K)).tocsr()
+    vectors = bm25(aggregate * counts)
+
+    # time interval of geographic clusters
+    start, end = time_intervals(np.hstack([start, end]),
+                                np.hstack([merged, merged]), G)
+
+    # only compare candidate pairs
+    pairs = candidate_pairs(start, end, window)
+    distance = cosine_distance(vectors, pairs=pairs)
+    clustering = hac.cluster(geo_clustering, distance, theta_text)
+
+    clustering.save(output_txt)
+
+    return clustering
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    pre_clustering_txt = arguments['<pre_clustering.txt>']
+    theta_geo = float(arguments['<theta_geo>'])
+    theta_text = float(arguments['<theta_text>'])
+    output_txt = arguments['<output.txt>']
+    metadata_dir = arguments['--metadata']
+    window = float(arguments['--window'])
+    fields = arguments['--fields'].split(',')
+    geo_txt = arguments['--geo']
+
+    do_it(pre_clustering_txt, theta_geo, theta_text, output_txt, metadata_dir,
+          window=window, fields=fields, geo_txt=geo_txt)
@@ -25,80 +25,236 @@
 
 """Generate cosine distance matrix between cluster centroids
 
+The centroid of a cluster is its medoid image: the one with the smallest sum
+of cosine distances to the other images of the cluster. As features are
+L2-normalized, this is the image whose features have the largest dot product
+with the sum of the features of the cluster -- no per-cluster distance
+matrix is needed.
+
+The output is either a dense K x K distance matrix (.npy, in sorted cluster
+order) computed one block of rows at a time or -- with --top -- a sparse
+matrix (.npz) only containing the distances to the k nearest centroids of
+each centroid or -- with --pairs -- a sparse matrix (.npz) only containing
+the distances between pairs stored in <pairs.npz> (e.g. candidate pairs from
+candidates.py).
+
 Usage:
-  cluster_distance.py <image.txt> <features.npy> <clustering.txt> <output.npy>
+  cluster_distance.py [--top=<k> | --pairs=<pairs.npz>] [--dtype=<dtype>] <image.txt> <features.npy> <clustering.txt> <output>
   cluster_distance.py (-h | --help)
   cluster_distance.py --version
 
 Options:
-  -h --help     Show this screen.
-  --version     Show version.
+  --top=<k>            Only keep the k nearest centroids of each centroid.
+  --pairs=<pairs.npz>  Only compute distance between pairs stored in sparse matrix.
+  --dtype=<dtype>      Precision of computation and output [default: float64].
+  -h --help            Show this screen.
+  --version            Show version.
 
 """
 from docopt import docopt
-from clustering import Clustering
+from cache import Cache
+from clustering import CompactClustering
+from matrix import load_matrix, save_matrix
+from pairwise import pairwise_distance, pair_distance, top_k
 import numpy as np
 
 
-def do_it(image_txt, features_npy, clustering_txt, output_npy):
+# number of images processed at once in medoid computation
+BLOCK = 4096
 
-    # load image list
-    with open(image_txt, 'r') as f:
-        images = [int(line.strip()) for line in f.readlines()]
-        image2index = {image: index for index, image in enumerate(images)}
+# relative tolerance (in machine epsilons of the features dtype) under which
+# medoid candidates are considered tied
+TOLERANCE = 100
 
-    # load hypothesis clusters
-    clustering = Clustering.load(clustering_txt)
+
+def l2_normalize(features, rows=None, dtype=np.float64, block=BLOCK):
+    """L2-normalized copy of (a subset of) features, one block at a time
+
+    Parameters
+    ----------
+    features : (N, d) numpy array
+        Possibly memory-mapped features (left untouched).
+    rows : numpy array, optional
+        Only normalize these rows (in this order). Defaults to all rows.
+    dtype : numpy dtype, optional
+        Defaults to float64.
+    block : int, optional
+        Number of rows processed at once.
+
+    Returns
+    -------
+    normalized : (len(rows), d) numpy array
+    """
+
+    if rows is None:
+        rows = np.arange(len(features))
+
+    normalized = np.empty((len(rows), features.shape[1]), dtype=dtype)
+    for start in range(0, len(rows), block):
+        chunk = normalized[start:start + block]
+        chunk[:] = features[rows[start:start + block]]
+        chunk /= np.sqrt(np.sum(chunk ** 2, axis=1))[:, np.newaxis]
+    return normalized
+
+
+def medoids(features, codes, n_clusters=None, block=BLOCK):
+    """Medoid of every cluster
+
+    Parameters
+    ----------
+    features : (N, d) numpy array
+        L2-normalized features.
+    codes : (N, ) numpy array
+        codes[i] is the index of the cluster containing image i.
+    n_clusters : int, optional
+        Defaults to max(codes) + 1.
+    block : int, optional
+        Number of images processed at once.
+
+    Returns
+    -------
+    medoids : (n_clusters, ) numpy array
+        medoids[k] is the index of the medoid image of cluster k
+        (first one in case of ties, -1 for empty clusters). Images with
+        non-finite features (e.g. unreadable images) are ignored, unless the
+        whole cluster is made of them, in which case its first image is used.
+    """
+
+    codes = np.asarray(codes)
+    if n_clusters is None:
+        n_clusters = np.max(codes) + 1
+
+    # images sorted by cluster (then by index)
+    order = np.argsort(codes, kind='mergesort')
+    sorted_codes = codes[order]
+    starts = np.searchsorted(sorted_codes, np.arange(n_clusters + 1))
+    present = np.diff(starts) > 0
+
+    # images with non-finite features (in sorted order)
+    valid = np.empty((len(order), ), dtype=bool)
+    for start in range(0, len(order), block):
+        valid[start:start + block] = np.all(
+            np.isfinite(features[order[start:start + block]]), axis=1)
+
+    # sum of features of every cluster (segment sums, one block at a time)
+    sums = np.zeros((n_clusters, features.shape[1]))
+    for start in range(0, len(order), block):
+        stop = min(len(order), start + block)
+        chunk_codes = sorted_codes[start:stop]
+        boundaries = np.where(np.diff(chunk_codes))[0] + 1
+        boundaries = np.hstack([[0], boundaries])
+        chunk = np.where(valid[start:stop, np.newaxis],
+                         features[order[start:stop]], 0.)
+        sums[chunk_codes[boundaries]] += np.add.reduceat(chunk, boundaries)
+
+    # sum over j of (1 - f_i.f_j) = size - f_i.sum
+    score = np.empty((len(order), ))
+    for start in range(0, len(order), block):
+        i = order[start:start + block]
+        score[start:start + block] = np.sum(
+            features[i] * sums[sorted_codes[start:start + block]], axis=1)
+    score[~valid] = -np.inf
+
+    # highest score of each cluster. scores closer than rounding errors are
+    # considered tied (e.g. both images of a two-image cluster) and the first
+    # image wins
+    sizes = np.diff(starts)[present]
+    best = np.maximum.reduceat(score, starts[:-1][present])
+    tolerance = TOLERANCE * np.finfo(features.dtype).eps
+    tied = score >= np.repeat(best - tolerance * sizes, sizes)
+    first = np.where(tied)[0]
+    first = first[np.searchsorted(first, starts[:-1][present])]
+
+    medoids = -np.ones((n_clusters, ), dtype=np.int64)
+    medoids[present] = order[first]
+    return medoids
+
+
+def cluster_distance(images, features, clustering, top=None,
+                     dtype=np.float64, pairs=None):
+    """Cosine distance between cluster medoids
+
+    Parameters
+    ----------
+    images : list
+        Images, in the order of features rows.
+    features : (N, d) numpy array
+        Possibly memory-mapped features.
+    clustering : CompactClustering
+    top : int, optional
+        Only keep distances to the `top` nearest medoids of each medoid.
+    dtype : numpy dtype, optional
+        Defaults to float64.
+    pairs : (K, K) scipy sparse matrix, optional
+        Only compute distances between pairs stored in this matrix.
+
+    Returns
+    -------
+    distance : (K, K) numpy array or scipy sparse matrix
+        In sorted cluster order.
+    """
+
+    image2index = {image: index for index, image in enumerate(images)}
     clusters = sorted(clustering.clusters)
 
-    # load features
-    features = np.load(features_npy)
+    # cluster index of every clustered image
+    index = {cluster: c for c, cluster in enumerate(clusters)}
+    _images = list(clustering)
+    _indices = np.array([image2index[image] for image in _images],
+                        dtype=np.int64)
+    codes = np.array([index[c] for c in clustering.to_list(_images)],
+                     dtype=np.int64)
 
-    # L2 normalization (for later dot product)
-    features = (features.T / np.sqrt(np.sum((features ** 2), axis=1))).T
+    # L2 normalization (for later dot product) of clustered images only
+    _features = l2_normalize(features, rows=_indices, dtype=dtype)
 
     # find centroid image for every cluster
-    centroid = {}
-    for c, cluster in enumerate(clusters):
+    centroid = medoids(_features, codes, n_clusters=len(clusters))
 
-        # list of images in current cluster
-        _images = clustering.clusters[cluster]
+    # compute distance matrix between all centroids
+    _features = _features[centroid, :]
+    if pairs is not None:
+        return pair_distance(_features, pairs, metric='cosine', dtype=dtype)
+    if top is None:
+        return pairwise_distance(_features, metric='cosine', dtype=dtype)
+    return top_k(_features, top, metric='cosine', dtype=dtype)
 
-        # corresponding indices in features matrix
-        _indices = [image2index[image] for image in _images]
 
-        # compute distance matrix between
-        # all images of current cluster
-        _features = features[_indices, :]
-        _distance = 1. - np.dot(_features, _features.T)
+def do_it(image_txt, features_npy, clustering_txt, output, top=None,
+          dtype=np.float64, pairs_npz=None):
 
-        # find centroid image
-        i = np.argmin(np.sum(_distance, axis=0))
-        centroid[cluster] = _images[i]
+    # load image list
+    with open(image_txt, 'r') as f:
+        images = [int(line.strip()) for line in f.readlines()]
 
-        print 'image %s is centroid of cluster %s' % (centroid[cluster], cluster)
+    # load hypothesis clusters
+    clustering = CompactClustering.load(clustering_txt)
 
-    # centroid indices in features matrix
-    _indices = [image2index[centroid[cluster]] for cluster in clusters]
+    # memory-map features (read-only, hence shareable between jobs)
+    features = np.load(features_npy, mmap_mode='r')
 
-    # compute distance matrix between all centroids
-    _features = features[_indices, :]
-    _distance = 1. - np.dot(_features, _features.T)
+    pairs = None if pairs_npz is None else load_matrix(pairs_npz)
+    _distance = cluster_distance(images, features, clustering, top=top,
+                                 dtype=dtype, pairs=pairs)
 
     # save distance matrix
-    with open(output_npy, 'wb') as f:
-        np.save(f, _distance)
+    save_matrix(output, _distance)
 
 
 if __name__ == '__main__':
 
     arguments = docopt(__doc__, version='0.1')
 
-    print arguments
-
     image_txt = arguments['<image.txt>']
     features_npy = arguments['<features.npy>']
     clustering_txt = arguments['<clustering.txt>']
-    distance_npy = arguments['<output.npy>']
+    output = arguments['<output>']
+    top = arguments['--top']
+    top = None if top is None else int(top)
+    dtype = np.dtype(arguments['--dtype'])
+    pairs_npz = arguments['--pairs']
 
-    do_it(image_txt, features_npy, clustering_txt, distance_npy)
+    Cache().run(__file__, [image_txt, features_npy, clustering_txt, pairs_npz],
+                {'top': top, 'dtype': str(dtype)}, [output],
+                do_it, image_txt, features_npy, clustering_txt, output,
+                top=top, dtype=dtype, pairs_npz=pairs_npz)
@@ -23,6 +23,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import itertools
+import numpy as np
+
 
 class Clustering(dict):
     """Clustering results
@@ -97,3 +100,230 @@ class Clustering(dict):
         return [self[item] for item in items]
 
 
+class CompactClustering(object):
+    """Array-backed clustering results
+
+    Same API as Clustering (load, save, to_list, clusters and item access)
+    but items and cluster codes are stored in parallel int64 arrays, cluster
+    codes being mapped to actual cluster labels through a union-find forest.
+
+    Assigning, deleting and looking up an item are O(1), loading is
+    vectorized and merging two clusters does not touch their members.
+
+    >>> c = CompactClustering.load(path)
+    >>> c[1] = 0       # image #1 is in cluster #0
+    >>> c[3] = 1       # image #3 is in cluster #1
+    >>> c.merge(0, 1)  # all images of cluster #1 are now in cluster #0
+    >>> c[3]
+    0
+
+    # c.clusters is built (and cached until next modification) on demand
+
+    >>> c.clusters[0]
+    [1, 3]
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CompactClustering, self).__init__()
+
+        # item rows
+        self._items = np.empty((0, ), dtype=np.int64)
+        self._codes = np.empty((0, ), dtype=np.int64)
+        self._row = {}
+
+        # cluster codes (union-find forest)
+        self._labels = np.empty((0, ), dtype=np.int64)
+        self._parent = np.empty((0, ), dtype=np.int64)
+        self._size = np.empty((0, ), dtype=np.int64)
+        self._code = {}
+        self._n_codes = 0
+
+        self._clusters = None
+
+        mapping = dict(*args, **kwargs)
+        if mapping:
+            items, labels = zip(*mapping.iteritems())
+            self._set_arrays(np.array(items, dtype=np.int64),
+                             np.array(labels, dtype=np.int64))
+
+    @classmethod
+    def from_arrays(cls, items, labels):
+        """Create clustering from parallel arrays of items and labels
+
+        Items must be unique.
+        """
+        clustering = cls()
+        clustering._set_arrays(np.array(items, dtype=np.int64),
+                               np.array(labels, dtype=np.int64))
+        return clustering
+
+    def _set_arrays(self, items, labels):
+        n = len(items)
+        self._items = items
+        labels, codes = np.unique(labels, return_inverse=True)
+        self._codes = codes.astype(np.int64)
+        self._row = dict(itertools.izip(items.tolist(), xrange(n)))
+        self._labels = labels
+        self._parent = np.arange(len(labels), dtype=np.int64)
+        self._size = np.bincount(self._codes, minlength=len(labels))
+        self._code = dict(itertools.izip(labels.tolist(),
+                                         xrange(len(labels))))
+        self._n_codes = len(labels)
+        self._clusters = None
+
+    @staticmethod
+    def _grow(array, size):
+        if size <= len(array):
+            return array
+        grown = np.empty((max(size, 2 * len(array)), ), dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def _find(self, code):
+        parent = self._parent
+        while parent[code] != code:
+            # path halving
+            parent[code] = parent[parent[code]]
+            code = parent[code]
+        return code
+
+    def _find_all(self, codes):
+        roots = self._parent[codes]
+        while True:
+            parents = self._parent[roots]
+            if np.all(parents == roots):
+                return roots
+            roots = parents
+
+    def _new_code(self, label):
+        code = self._n_codes
+        self._n_codes = code + 1
+        self._labels = self._grow(self._labels, code + 1)
+        self._parent = self._grow(self._parent, code + 1)
+        self._size = self._grow(self._size, code + 1)
+        self._labels[code] = label
+        self._parent[code] = code
+        self._size[code] = 0
+        self._code[label] = code
+        return code
+
+    def _release(self, root):
+        self._size[root] -= 1
+        if self._size[root] == 0:
+            del self._code[self._labels[root]]
+
+    def __len__(self):
+        return len(self._row)
+
+    def __contains__(self, item):
+        return item in self._row
+
+    def __iter__(self):
+        return iter(self._items[:len(self)].tolist())
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        n = len(self)
+        labels = self._labels[self._find_all(self._codes[:n])]
+        return itertools.izip(self._items[:n].tolist(), labels.tolist())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __getitem__(self, item):
+        return int(self._labels[self._find(self._codes[self._row[item]])])
+
+    def __setitem__(self, item, label):
+        self._clusters = None
+
+        row = self._row.get(item)
+        if row is None:
+            row = len(self)
+            self._items = self._grow(self._items, row + 1)
+            self._codes = self._grow(self._codes, row + 1)
+            self._items[row] = item
+            self._row[item] = row
+        else:
+            self._release(self._find(self._codes[row]))
+
+        code = self._code.get(label)
+        if code is None:
+            code = self._new_code(label)
+        self._codes[row] = code
+        self._size[code] += 1
+
+    def __delitem__(self, item):
+        self._clusters = None
+        row = self._row.pop(item)
+        self._release(self._find(self._codes[row]))
+
+        # move last row into the hole
+        last = len(self)
+        if row != last:
+            moved = self._items[last]
+            self._items[row] = moved
+            self._codes[row] = self._codes[last]
+            self._row[int(moved)] = row
+
+    def merge(self, label1, label2):
+        """Merge cluster label2 into cluster label1"""
+        if label1 == label2:
+            return
+        self._clusters = None
+        root1 = self._code[label1]
+        root2 = self._code.pop(label2)
+        # union by size
+        if self._size[root1] < self._size[root2]:
+            root1, root2 = root2, root1
+        self._parent[root2] = root1
+        self._size[root1] += self._size[root2]
+        self._labels[root1] = label1
+        self._code[label1] = root1
+
+    @property
+    def clusters(self):
+        if self._clusters is None:
+            n = len(self)
+            labels = self._labels[self._find_all(self._codes[:n])]
+            order = np.argsort(labels, kind='mergesort')
+            labels = labels[order]
+            items = self._items[:n][order]
+            boundaries = np.where(np.diff(labels))[0] + 1
+            self._clusters = {
+                int(group[0]): members.tolist()
+                for group, members in itertools.izip(
+                    np.split(labels, boundaries),
+                    np.split(items, boundaries)) if len(group)}
+        return self._clusters
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            data = np.fromstring(f.read(), dtype=np.int64, sep=' ')
+        items, labels = data[0::2], data[1::2]
+
+        # in case an item appears more than once, the last line wins
+        _, last = np.unique(items[::-1], return_index=True)
+        if len(last) < len(items):
+            keep = np.sort(len(items) - 1 - last)
+            items, labels = items[keep], labels[keep]
+
+        return cls.from_arrays(items, labels)
+
+    def save(self, path):
+        n = len(self)
+        labels = self._labels[self._find_all(self._codes[:n])]
+        np.savetxt(path, np.vstack([self._items[:n], labels]).T, fmt='%d %d')
+
+    def to_list(self, items):
+        labels = self._labels[self._find_all(
+            self._codes[[self._row[item] for item in items]])]
+        return labels.tolist()
+
+    def to_arrays(self):
+        """Parallel arrays of items and their cluster labels"""
+        n = len(self)
+        labels = self._labels[self._find_all(self._codes[:n])]
+        return self._items[:n].copy(), labels
@@ -26,8 +26,13 @@
 """
 Compute color histograms for list of images.
 
+Histograms are streamed into a memory-mapped <output.npy>, one chunk of
+images at a time and in image list order. Rows of images that could not be
+processed are NaN. When <output.npy> already exists (e.g. after a crash),
+only NaN rows are (re)computed.
+
 Usage:
-  color_histogram [-R <R>] [-G <G>] [-B <B>] [-H <H>] [-S <S>] [-V <V>] <input.dir> <image.txt> <output.npy>
+  color_histogram [-R <R>] [-G <G>] [-B <B>] [-H <H>] [-S <S>] [-V <V>] [--reduce=<factor>] [--dtype=<dtype>] [--jobs=<jobs>] [--chunk=<chunk>] <input.dir> <image.txt> <output.npy>
   color_histogram -h | --help
   color_histogram --version
 
@@ -38,15 +43,21 @@ Options:
   -H <H> --hue=<H>         Set number of bins in H channel [default: 0]
   -S <S> --saturation=<S>  Set number of bins in S channel [default: 0]
   -V <V> --value=<V>       Set number of bins in V channel [default: 0]
+  --reduce=<factor>        Decode images at 1/factor of their size (1, 2, 4
+                           or 8) [default: 1]
+  --dtype=<dtype>          Output precision [default: float64]
+  --jobs=<jobs>            Number of worker processes [default: 1]
+  --chunk=<chunk>          Number of images written at once [default: 256]
   -h --help                Show this screen.
   --version                Show version.
 """
 
 from docopt import docopt
 from path import path
+from multiprocessing import Pool
+import itertools
 import numpy as np
 import cv2
-import cv
 
 
 COLOR_RANGES = {
@@ -59,6 +70,21 @@ COLOR_RANGES = {
 }
 
 
+def bin_lookup_table(bins, range_):
+    """Bin index of every uint8 value (-1 when out of range)
+
+    Bins are the same as those of np.histogramdd(..., bins=bins,
+    range=range_): the last bin includes its right edge.
+    """
+    edges = np.linspace(range_[0], range_[1], bins + 1)
+    values = np.arange(256, dtype=np.float64)
+    index = np.searchsorted(edges, values, side='right')
+    index[values == edges[-1]] -= 1
+    index = index - 1
+    index[(index < 0) | (index >= bins)] = -1
+    return index
+
+
 class ColorHistogram(object):
     """
 
@@ -67,6 +93,9 @@ class ColorHistogram(object):
     B, G, R, H, S, V : int, optional
         Number of bins in blue, green, red, hue, saturation and value channels.
         Setting it to 0 (default) means the corresponding channel is not used.
+    reduce : {1, 2, 4, 8}, optional
+        Compute histogram on an image decoded at 1/reduce of its size.
+        Defaults to 1 (full resolution).
 
     Usage
     -----
@@ -75,22 +104,56 @@ class ColorHistogram(object):
 
     """
 
-    def __init__(self, H=0, S=0, V=0, R=0, G=0, B=0):
+    def __init__(self, H=0, S=0, V=0, R=0, G=0, B=0, reduce=1):
         super(ColorHistogram, self).__init__()
 
         # number of bins for each channel
         self.bins = {'H': H, 'S': S, 'V': V, 'R': R, 'G': G, 'B': B}
+        self.reduce = reduce
 
         # histogram dimension
-        self._dimension = sum([v > 0 for _, v in self.bins.iteritems()])
+        self._dimension = int(self.get_dimension())
+
+        # for each requested channel (in histogram dimension order), lookup
+        # table from uint8 value to its contribution to the flat bin index.
+        # out-of-range values are sent beyond the last bin.
+        self._luts = []
+        stride = 1
+        for channel in 'VSHRGB':
+            if not self.bins[channel]:
+                continue
+            lut = bin_lookup_table(self.bins[channel], COLOR_RANGES[channel])
+            lut = np.where(lut < 0, self._dimension, stride * lut)
+            self._luts.insert(0, (channel, lut.astype(np.int32)))
+            stride *= self.bins[channel]
+
+        self._hsv = self.bins['H'] or self.bins['S'] or self.bins['V']
 
     def get_dimension(self):
         return np.prod([v for v in self.bins.values() if v > 0])
 
+    def _imread(self, path):
+
+        if self.reduce == 1:
+            return cv2.imread(path)
+
+        # let libjpeg decode a downscaled image when OpenCV supports it
+        flag = getattr(cv2, 'IMREAD_REDUCED_COLOR_%d' % self.reduce, None)
+        if flag is not None:
+            return cv2.imread(path, flag)
+
+        bgr = cv2.imread(path)
+        if bgr is None:
+            return None
+        height, width, _ = bgr.shape
+        return cv2.resize(bgr, (max(1, width // self.reduce),
+                                max(1, height // self.reduce)),
+                          interpolation=cv2.INTER_AREA)
+
     def __call__(self, path):
 
         # load image in BGR (blue-green-red) colorspace
-        bgr = cv2.imread(path)
+        bgr = self._imread(path)
         if bgr is None:
             print 'ERROR: cannot compute histogram for %s' % path
             return np.NaN
@@ -99,80 +162,114 @@ class ColorHistogram(object):
         width, height, _ = bgr.shape
 
         # convert to HSV (hue-saturation-value) only if needed afterwards
-        if self.bins['H'] or self.bins['S'] or self.bins['V']:
-            hsv = cv2.cvtColor(bgr, cv.CV_BGR2HSV)
-            # reshape to (WxH, 3)
-            hsv = hsv.T.reshape((3, -1)).T
+        if self._hsv:
+            hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+
+        # flat bin index of every pixel
+        index = None
+        for channel, lut in self._luts:
+            image = hsv if channel in 'HSV' else bgr
+            values = lut[image[:, :, 'BGRHSV'.index(channel) % 3]]
+            if index is None:
+                index = values
+            else:
+                index += values
+
+        # count pixels in each bin (out-of-range pixels are dropped)
+        histogram = np.bincount(index.ravel(),
+                                minlength=self._dimension)[:self._dimension]
 
-        # reshape BGR only if needed afterwards
-        if self.bins['B'] or self.bins['G'] or self.bins['R']:
-            # reshape to (WxH, 3)
-            bgr = bgr.T.reshape((3, -1)).T
+        # return it as a 1 x nbins array
+        return histogram.reshape((1, -1)) / float(width * height)
 
-        # this numpy array will have one row per channels
-        X = np.empty((width * height, self._dimension))
 
-        # d is current row index
-        d = 0
+def histogram_intersection(histogram1, histogram2):
+    return 1. - np.sum(np.minimum(histogram1, histogram2))
 
-        # number of bins for each channel
-        bins = []
-
-        # variation range for each channel
-        ranges = []
-
-        # add B, G and/or R channel if requested
-        for i, channel in enumerate('BGR'):
-            if self.bins[channel]:
-                bins.append(self.bins[channel])
-                ranges.append(COLOR_RANGES[channel])
-                X[:, d] = bgr[:, i]
-                d = d + 1
-
-        # add H, S and/or V channel if requested
-        for i, channel in enumerate('HSV'):
-            if self.bins[channel]:
-                bins.append(self.bins[channel])
-                ranges.append(COLOR_RANGES[channel])
-                X[:, d] = hsv[:, i]
-                d = d + 1
-
-        # compute multi-dimensional histogram
-        histogram, _ = np.histogramdd(X, bins=bins, range=ranges)
 
-        # return it as a 1 x nbins array
-        return histogram.reshape((1, -1)) / (width * height)
+# extractor used by worker processes (see do_it)
+extractor = None
 
 
-def histogram_intersection(histogram1, histogram2):
-    return 1. - np.sum(np.minimum(histogram1, histogram2))
+def _initialize(parameters):
+    global extractor
+    extractor = ColorHistogram(**parameters)
+
+
+def _extract_chunk(args):
+    rows, paths = args
+    data = np.empty((len(rows), extractor.get_dimension()), dtype=float)
+    for r, pathToImage in enumerate(paths):
+        data[r, :] = extractor(pathToImage)
+    return rows, data
+
+
+def _open_output(output_npy, shape, dtype=float):
+    """Open existing output for resuming, or create a NaN-filled one"""
+
+    if path(output_npy).exists():
+        data = np.load(output_npy, mmap_mode='r+')
+        if data.shape == shape and data.dtype == dtype:
+            return data
+        print 'WARNING: overwriting %s (shape or dtype mismatch)' % output_npy
+        del data
+
+    data = np.lib.format.open_memmap(output_npy, mode='w+',
+                                     dtype=dtype, shape=shape)
+    data[:] = np.NaN
+    return data
 
 
 def do_it(input_dir, image_txt, output_npy,
-          R=0, G=0, B=0, H=0, S=0, V=0):
+          R=0, G=0, B=0, H=0, S=0, V=0, reduce=1, dtype=float,
+          jobs=1, chunk=256):
 
-    # initial color histogram extractor
-    extractor = ColorHistogram(R=R, G=G, B=B, H=H, S=S, V=V)
+    parameters = {'R': R, 'G': G, 'B': B, 'H': H, 'S': S, 'V': V,
+                  'reduce': reduce}
 
     # load image list
     with open(image_txt, 'r') as f:
         images = [image.strip() for image in f.readlines()]
 
     nImages = len(images)
-    nDimensions = extractor.get_dimension()
-    data = np.empty((nImages, nDimensions), dtype=float)
-
-    for i, image in enumerate(images):
-
-        if i % 1000 == 0:
-            print 'Processing image {i} / {n}'.format(i=i + 1, n=len(images))
-
-        # 100024928 --> /path/to/input/dir/100024928.jpg
-        pathToImage = path.joinpath(input_dir, image + '.jpg')
-        data[i, :] = extractor(pathToImage)
-
-    with open(output_npy, 'wb') as f:
-        np.save(f, data)
+    nDimensions = ColorHistogram(**parameters).get_dimension()
+    data = _open_output(output_npy, (nImages, nDimensions), dtype=dtype)
+
+    # only process images whose histogram is missing
+    todo = []
+    for start in range(0, nImages, chunk):
+        missing = np.all(np.isnan(data[start:start + chunk]), axis=1)
+        todo.extend(start + np.where(missing)[0])
+    if len(todo) < nImages:
+        print 'Resuming: {n} / {N} images left'.format(n=len(todo), N=nImages)
+
+    # 100024928 --> /path/to/input/dir/100024928.jpg
+    chunks = [(todo[start:start + chunk],
+               [path.joinpath(input_dir, images[i] + '.jpg')
+                for i in todo[start:start + chunk]])
+              for start in range(0, len(todo), chunk)]
+
+    if jobs > 1:
+        pool = Pool(processes=jobs, initializer=_initialize,
+                    initargs=(parameters, ))
+        results = pool.imap(_extract_chunk, chunks)
+    else:
+        _initialize(parameters)
+        results = itertools.imap(_extract_chunk, chunks)
+
+    # results come back in order, one chunk at a time
+    done = 0
+    for rows, histograms in results:
+        data[rows] = histograms
+        data.flush()
+        done += len(rows)
+        print 'Processed image {i} / {n}'.format(i=done, n=len(todo))
+
+    if jobs > 1:
+        pool.close()
+        pool.join()
+
+    del data
 
 
 if __name__ == '__main__':
@@ -189,7 +286,12 @@ if __name__ == '__main__':
     input_dir = arguments['<input.dir>']
     image_txt = arguments['<image.txt>']
     output_npy = arguments['<output.npy>']
+    jobs = int(arguments['--jobs'])
+    chunk = int(arguments['--chunk'])
+    reduce = int(arguments['--reduce'])
+    dtype = np.dtype(arguments['--dtype'])
 
     do_it(input_dir, image_txt, output_npy,
-          R=r, G=g, B=b, H=h, S=s, V=v)
+          R=r, G=g, B=b, H=h, S=s, V=v,
+          reduce=reduce, dtype=dtype, jobs=jobs, chunk=chunk)
 
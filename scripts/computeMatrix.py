@@ -1,99 +1,153 @@
-import numpy, codecs, itertools, math
-import simplejson as json
-from datetime import *
+import numpy, codecs, math, sys
+import scipy.sparse
+from cache import Cache
+from matrix import save_matrix
+from metadata import Metadata
 
 
-def computeUserMatrix(dictionary, listID):
-	with codecs.open(listID, "rt", encoding='utf8') as fic:
-		imgs = [int(line.strip()) for line in fic]
+# number of rows (and columns) of each tile processed at once.
+# peak memory is about a few (TILE x TILE) float64 arrays on top of the output
+TILE = 2048
 
-	matrix = numpy.eye(len(imgs), dtype=int)
-	for (i, img_i), (j, img_j) in itertools.combinations(enumerate(imgs), 2):
-		if img_i in dictionary and img_j in dictionary:
-			userI = dictionary[img_i]['username']
-			userJ = dictionary[img_j]['username']
-			if userI == userJ:
-				matrix[i][j]=1
-				matrix[j][i]=1
-		else:
-			print "Unable to found image %d in json file" % (img_i)
-			return None
-	return matrix
+def tiles(n, tile=TILE):
+	for start in range(0, n, tile):
+		yield slice(start, min(n, start + tile))
 
-def computeDateTakenMatrix(dictionary, listID):
+def readList(metadata, listID):
 	with codecs.open(listID, "rt", encoding='utf8') as fic:
 		imgs = [int(line.strip()) for line in fic]
+	try:
+		return metadata.index(imgs)
+	except KeyError as e:
+		print "Unable to found image %d in metadata" % (e.args[0])
+		return None
 
-	matrix = numpy.zeros((len(imgs), len(imgs)))
-	for (i, img_i), (j, img_j) in itertools.combinations(enumerate(imgs), 2):
-		if img_i in dictionary and img_j in dictionary:
-			dateI = datetime.strptime(dictionary[img_i]['dateTaken'], "%Y-%m-%d %H:%M:%S")
-			dateJ = datetime.strptime(dictionary[img_j]['dateTaken'], "%Y-%m-%d %H:%M:%S")
-			diff = dateJ-dateI
-			diff_seconds = abs(diff.total_seconds())
-			matrix[i][j]=diff_seconds
-			matrix[j][i]=diff_seconds
-		else:
-			print "Unable to found image %d in json file" % (img_i)
-			return None
-	return matrix
+def fillMatrix(n, block, dtype=float, tile=TILE, keep=None):
+	# dense mode: fill n x n matrix with block(I, J) tile by tile
+	# sparse mode (keep is provided): only store entries where keep(values)
+	# is True in a CSR matrix -- including explicit zeros
+	if keep is None:
+		matrix = numpy.empty((n, n), dtype=dtype)
+		for I in tiles(n, tile):
+			for J in tiles(n, tile):
+				matrix[I, J] = block(I, J)
+		return matrix
 
-def computeDistanceMatrix(dictionary, listID):
-	with codecs.open(listID, "rt", encoding='utf8') as fic:
-		imgs = [int(line.strip()) for line in fic]
+	rows, cols, data = [], [], []
+	for I in tiles(n, tile):
+		for J in tiles(n, tile):
+			values = block(I, J)
+			# NaN never passes the cutoff
+			with numpy.errstate(invalid='ignore'):
+				i, j = numpy.nonzero(keep(values))
+			rows.append(i + I.start)
+			cols.append(j + J.start)
+			data.append(values[i, j].astype(dtype))
+	rows = numpy.hstack(rows)
+	cols = numpy.hstack(cols)
+	data = numpy.hstack(data)
+	return scipy.sparse.coo_matrix((data, (rows, cols)), shape=(n, n)).tocsr()
 
-	matrix = numpy.zeros((len(imgs), len(imgs)))
-	for (i, img_i), (j, img_j) in itertools.combinations(enumerate(imgs), 2):
-		if img_i in dictionary and img_j in dictionary:
-			obj_i = dictionary[img_i]
-			obj_j = dictionary[img_j]
-			if not 'longitude' in obj_i or not 'longitude' in obj_j:
-				matrix[i][j] = numpy.nan
-				matrix[j][i] = numpy.nan
-				if not 'longitude' in obj_i:
-					matrix[i][i] = numpy.nan
-			else:
-				distance = distance_on_unit_sphere(obj_i['latitude'], obj_i['longitude'], obj_j['latitude'], obj_j['longitude'])
-				matrix[i][j] = distance
-				matrix[j][i] = distance
-		else:
-			print "Unable to found image %d in json file" % (img_i)
-			return None
-	return matrix
+def computeUserMatrix(metadata, listID, tile=TILE, sparse=False):
+	# sparse mode only keeps pairs of images from the same user
+	rows = readList(metadata, listID)
+	if rows is None:
+		return None
+
+	users = metadata.username[rows]
+
+	def block(I, J):
+		return users[I, numpy.newaxis] == users[numpy.newaxis, J]
+
+	keep = (lambda values: values) if sparse else None
+	return fillMatrix(len(rows), block, dtype=int, tile=tile, keep=keep)
+
+def computeDateTakenMatrix(metadata, listID, tile=TILE, cutoff=None):
+	# sparse mode (cutoff in seconds) only keeps pairs with |dt| < cutoff
+	rows = readList(metadata, listID)
+	if rows is None:
+		return None
+
+	dates = metadata.dateTaken[rows]
+
+	def block(I, J):
+		return numpy.abs(dates[numpy.newaxis, J] - dates[I, numpy.newaxis])
+
+	keep = None if cutoff is None else (lambda values: values < cutoff)
+	return fillMatrix(len(rows), block, tile=tile, keep=keep)
+
+def computeDistanceMatrix(metadata, listID, tile=TILE, cutoff=None):
+	# sparse mode (cutoff in km) only keeps pairs with distance < cutoff
+	rows = readList(metadata, listID)
+	if rows is None:
+		return None
+
+	# NaN coordinates propagate to NaN distances
+	# for photos that are not geotagged (including the diagonal)
+	latitude = metadata.latitude[rows]
+	longitude = metadata.longitude[rows]
+
+	def block(I, J):
+		return distance_on_unit_sphere(
+			latitude[I, numpy.newaxis], longitude[I, numpy.newaxis],
+			latitude[numpy.newaxis, J], longitude[numpy.newaxis, J])
+
+	keep = None if cutoff is None else (lambda values: values < cutoff)
+	return fillMatrix(len(rows), block, tile=tile, keep=keep)
 
 def distance_on_unit_sphere(lat1, long1, lat2, long2):
-   # Convert latitude and longitude to 
-   # spherical coordinates in radians.
+   # Great-circle distance (in km) with the haversine formula,
+   # which is well-conditioned for small distances.
+   # Works with scalars as well as (broadcastable) numpy arrays.
    degrees_to_radians = math.pi/180.0
-   # phi = 90 - latitude
-   phi1 = (90.0 - lat1)*degrees_to_radians
-   phi2 = (90.0 - lat2)*degrees_to_radians
-   # theta = longitude
-   theta1 = long1*degrees_to_radians
-   theta2 = long2*degrees_to_radians
-   # Compute spherical distance from spherical coordinates.
-   # For two locations in spherical coordinates 
-   # (1, theta, phi) and (1, theta, phi)
-   # cosine( arc length ) = 
-   #    sin phi sin phi' cos(theta-theta') + cos phi cos phi'
-   # distance = rho * arc length
-   cos = (math.sin(phi1)*math.sin(phi2)*math.cos(theta1 - theta2) + 
-          math.cos(phi1)*math.cos(phi2))
-   arc = math.acos( cos )
+   phi1 = lat1*degrees_to_radians
+   phi2 = lat2*degrees_to_radians
+   dphi = phi2 - phi1
+   dlambda = (long2 - long1)*degrees_to_radians
+   # hav(arc) = hav(dphi) + cos phi cos phi' hav(dlambda)
+   # with hav(x) = sin^2(x / 2)
+   hav = (numpy.sin(dphi / 2.)**2 +
+          numpy.cos(phi1)*numpy.cos(phi2)*numpy.sin(dlambda / 2.)**2)
+   # rounding errors may push hav slightly above 1
+   arc = 2. * numpy.arcsin( numpy.sqrt( numpy.minimum(hav, 1.) ) )
    # Remember to multiply arc by the radius of the earth 
    # in your favorite set of units to get length.
    return arc * 6371
 
-def readjson(jsonFile):
-	dictionary=None
-	with codecs.open(jsonFile, "rt", encoding="utf8") as fic:
-		data = [json.loads(line) for line in fic]
-		dictionary = {obj['photoID']: obj for obj in data}
-	return dictionary
-
-print "Loading json into memory..."
-dictionary = readjson("/vol/corpora4/mediaeval/2014/SED_2014_Dev_Metadata.json")
-print "...Done !"
-computeUserMatrix(dictionary, "/people/laurent/sed2014/repo/byzance/Dev_dataset/SED_2014_Dev_A_Pictures.txt")
-computeDateTakenMatrix(dictionary, "/people/laurent/sed2014/repo/byzance/Dev_dataset/SED_2014_Dev_A_Pictures.txt")
-computeDistanceMatrix(dictionary, "/people/laurent/sed2014/repo/byzance/Dev_dataset/SED_2014_Dev_A_Pictures.txt")
+# python computeMatrix.py date ../Dev_dataset/SED_2014_Dev_A_Pictures.txt date_Dev_A.npy
+# python computeMatrix.py date ../Dev_dataset/SED_2014_Dev_A_Pictures.txt date_Dev_A.npz 172800
+# python computeMatrix.py geo ../Dev_dataset/SED_2014_Dev_A_Pictures.txt geo_Dev_A.npz 1
+# python computeMatrix.py user ../Dev_dataset/SED_2014_Dev_A_Pictures.txt user_Dev_A.npz
+
+# saving to .npz switches to sparse mode, keeping only pairs from the same
+# user or pairs below the cutoff (seconds for date, km for geo)
+
+if __name__ == '__main__':
+	matrixType = sys.argv[1]
+	fileID = sys.argv[2]
+	fileOUT = sys.argv[3]
+	sparse = fileOUT.endswith('.npz')
+	cutoff = float(sys.argv[4]) if len(sys.argv) > 4 else None
+	if sparse and matrixType != 'user' and cutoff is None:
+		sys.exit("Sparse %s matrix needs a cutoff" % matrixType)
+	if not sparse:
+		cutoff = None
+
+	metadata = Metadata("/vol/corpora4/mediaeval/2014/SED_2014_Dev_Metadata")
+
+	def compute():
+		if matrixType == 'user':
+			matrix = computeUserMatrix(metadata, fileID, sparse=sparse)
+		elif matrixType == 'date':
+			matrix = computeDateTakenMatrix(metadata, fileID, cutoff=cutoff)
+		elif matrixType == 'geo':
+			matrix = computeDistanceMatrix(metadata, fileID, cutoff=cutoff)
+		else:
+			sys.exit("Unknown matrix type %s (user, date or geo)" % matrixType)
+
+		if matrix is not None:
+			save_matrix(fileOUT, matrix)
+
+	Cache().run(__file__, [fileID, metadata.path],
+	            {'type': matrixType, 'sparse': sparse, 'cutoff': cutoff},
+	            [fileOUT], compute)
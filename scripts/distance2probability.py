@@ -25,55 +25,316 @@
 
 """Convert distance to probability
 
+Distance matrices can either be dense (.npy) or sparse (.npz). In the latter
+case, only stored entries are used for training and converted to
+probabilities (and the output probability matrix is sparse as well).
+
+Training only reads the upper triangle of (memory-mapped) matrices, one
+block of rows at a time. The diagonal, entries that are neither positive (1)
+nor negative (0) in the groundtruth (e.g. -1 from groundtruth.py) and
+non-finite distances are ignored. The groundtruth may also be given as the
+condensed vector of its upper triangle (see groundtruth.py --upper).
+
+By default, positive and negative scores are accumulated into histograms and
+the isotonic regression is fitted on these histograms -- which is what
+pyannote's LLRIsotonicRegression.fit does internally, without ever holding
+all scores in memory. With --sample, the histograms are built from a random
+subsample of scores instead.
+
+The model is saved as a small .npz lookup table: the log-likelihood ratio at
+each breakpoint of the (piecewise-linear) isotonic regression. Applying it
+only needs numpy and is done one block of rows at a time, from memory-mapped
+input to memory-mapped output (dense matrices).
+
 Usage:
-  distance2probability.py train <distance_matrix> <groundtruth_matrix> <d2p_model>
+  distance2probability.py train [--bins=<bins> | --sample=<n>] <distance_matrix> <groundtruth_matrix> <d2p_model>
   distance2probability.py apply <distance_matrix> <d2p_model> <probability_matrix>
   distance2probability.py (-h | --help)
   distance2probability.py --version
 
 Options:
-  -h --help     Show this screen.
-  --version     Show version.
+  --bins=<bins>  Number of histogram bins [default: 100].
+  --sample=<n>   Train on (about) n randomly selected scores.
+  -h --help      Show this screen.
+  --version      Show version.
 
 """
 
 from docopt import docopt
-from pyannote.algorithms.stats.llr import LLRIsotonicRegression
+from cache import Cache
+from matrix import load_matrix, save_matrix, get_entries, upper_offset
+import scipy.sparse
 import numpy as np
-import pickle
 
 
-def do_train(distance_matrix, groundtruth_matrix, d2p_model):
+# number of rows processed at once
+BLOCK = 256
+
+# random seed used for subsampling
+SEED = 1234
+
+
+def upper_triangle(x, y, block=BLOCK):
+    """Iterate over training (score, label) pairs of the upper triangle
+
+    Parameters
+    ----------
+    x : numpy array or scipy sparse matrix
+        (Possibly memory-mapped) distance matrix. Only stored entries of
+        sparse matrices are used.
+    y : numpy array or scipy sparse matrix
+        (Possibly memory-mapped) groundtruth matrix, or condensed vector of
+        its strict upper triangle (see groundtruth.py --upper).
+    block : int, optional
+        Number of rows processed at once.
+
+    Yields
+    ------
+    score : numpy array
+        Negated distances.
+    label : numpy array
+        Corresponding groundtruth (0 or 1).
+    """
+
+    def select(distance, label):
+        keep = ((label == 0) | (label == 1)) & np.isfinite(distance)
+        return -distance[keep], label[keep]
+
+    if scipy.sparse.issparse(x):
+        x = x.tocoo()
+        upper = x.row < x.col
+        rows, cols = x.row[upper], x.col[upper]
+        if not scipy.sparse.issparse(y) and y.ndim == 1:
+            label = np.asarray(y[upper_offset(x.shape[0], rows) +
+                                 cols - rows - 1])
+        else:
+            label = get_entries(y, rows, cols)
+        yield select(x.data[upper], label)
+        return
+
+    K = x.shape[0]
+    for start in range(0, K, block):
+        stop = min(K, start + block)
+
+        # strictly upper part of rows start to stop
+        rows = np.arange(start, stop)[:, np.newaxis]
+        cols = np.arange(start, K)[np.newaxis, :]
+        upper = cols > rows
+
+        distance = np.asarray(x[start:stop, start:])[upper]
+        if scipy.sparse.issparse(y):
+            r, c = np.where(upper)
+            label = get_entries(y, start + r, start + c)
+        elif y.ndim == 1:
+            # condensed upper triangle stores the same entries, same order
+            label = np.asarray(y[upper_offset(K, start):upper_offset(K, stop)])
+        else:
+            label = np.asarray(y[start:stop, start:])[upper]
+
+        yield select(distance, label)
+
+
+def fit_histogram(entries, nbins=100):
+    """Train calibration model from histograms of scores
+
+    Same as LLRIsotonicRegression(equal_priors=True).fit(score, label) but
+    scores are streamed (twice) instead of being held in memory.
+
+    Parameters
+    ----------
+    entries : callable
+        Returns an iterator over (score, label) chunks (see upper_triangle).
+    nbins : int, optional
+        Number of histogram bins. Defaults to 100.
+
+    Returns
+    -------
+    model : dict
+        Piecewise-linear log-likelihood ratio (see posterior_probability).
+    """
+
+    # only needed for training
+    from sklearn.isotonic import IsotonicRegression
+
+    # 1st pass: score range and prior
+    m, M = np.inf, -np.inf
+    n_positive, n_negative = 0, 0
+    for score, label in entries():
+        if len(score):
+            m, M = min(m, np.min(score)), max(M, np.max(score))
+        n_positive += np.sum(label == 1)
+        n_negative += np.sum(label == 0)
+
+    # same bins as LLR._get_scores_ratios
+    bins = np.arange(m, M, (M - m) / nbins)
+
+    # 2nd pass: histograms of positive and negative scores
+    positive = np.zeros((len(bins) - 1, ), dtype=np.int64)
+    negative = np.zeros((len(bins) - 1, ), dtype=np.int64)
+    for score, label in entries():
+        positive += np.histogram(score[label == 1], bins=bins)[0]
+        negative += np.histogram(score[label == 0], bins=bins)[0]
+
+    # same as np.histogram(..., density=True)
+    db = np.array(np.diff(bins), float)
+    p = positive / db / positive.sum()
+    n = negative / db / negative.sum()
+
+    scores = .5 * (bins[:-1] + bins[1:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.log(1. * p / n)
+
+    ok = np.where(np.isfinite(ratios))
+    scores = scores[ok]
+    ratios = ratios[ok]
+
+    # same as LLRIsotonicRegression.fit
+    ir = IsotonicRegression(y_min=np.min(ratios), y_max=np.max(ratios))
+    ir.fit(scores, ratios)
+
+    # isotonic regression is linear between training scores
+    return {
+        'score': scores,
+        'llr': ir.transform(scores),
+        'llr_min': ir.y_min,
+        'llr_max': ir.y_max,
+        # equal priors
+        'prior': .5,
+        'estimated_prior': 1. * n_positive / (n_positive + n_negative),
+    }
+
+
+def fit_sample(entries, sample, nbins=100, seed=SEED):
+    """Train calibration model on a random subsample of scores
+
+    Parameters
+    ----------
+    entries : callable
+        Returns an iterator over (score, label) chunks (see upper_triangle).
+    sample : int
+        Approximate number of scores used for training.
+    """
+
+    total = sum(len(score) for score, _ in entries())
+    probability = min(1., 1. * sample / max(1, total))
+
+    random = np.random.RandomState(seed)
+    x, y = [], []
+    for score, label in entries():
+        keep = random.rand(len(score)) < probability
+        x.append(score[keep])
+        y.append(label[keep])
+    x, y = np.hstack(x), np.hstack(y)
+
+    return fit_histogram(lambda: iter([(x, y)]), nbins=nbins)
+
+
+def save_model(path, model):
+    # file object so that numpy does not append .npz extension
+    with open(path, 'wb') as f:
+        np.savez(f, **model)
+
+
+def load_model(path):
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def posterior_probability(model, distance):
+    """Convert distance to posterior probability
+
+    Same as LLRIsotonicRegression.toPosteriorProbability(-distance): the
+    log-likelihood ratio is interpolated linearly between model breakpoints
+    (and saturates outside), NaN distances have a log-likelihood ratio of 0.
+    """
+
+    score = -np.asarray(distance, dtype=np.float64)
+    llr = np.interp(score, model['score'], model['llr'],
+                    left=model['llr_min'], right=model['llr_max'])
+    llr[np.isnan(score)] = 0.
+
+    prior = model['prior']
+    priorRatio = (1. - prior) / prior
+    return 1 / (1 + priorRatio * np.exp(-llr))
+
+
+def train(x, y, nbins=100, sample=None):
+    """Train calibration model
+
+    Parameters
+    ----------
+    x : numpy array or scipy sparse matrix
+        (Possibly memory-mapped) distance matrix.
+    y : numpy array or scipy sparse matrix
+        (Possibly memory-mapped) groundtruth matrix or condensed vector.
+    nbins : int, optional
+        Number of histogram bins. Defaults to 100.
+    sample : int, optional
+        Train on (about) this many randomly selected scores.
+    """
+
+    def entries():
+        return upper_triangle(x, y)
+
+    if sample is None:
+        return fit_histogram(entries, nbins=nbins)
+    return fit_sample(entries, sample, nbins=nbins)
+
+
+def apply_model(model, x, out=None, block=BLOCK):
+    """Convert distance matrix to probability matrix
+
+    Only stored entries are converted in case of sparse matrix. Dense
+    matrices are converted one block of rows at a time, into `out` (e.g. a
+    memory-mapped array) when provided.
+    """
+
+    if scipy.sparse.issparse(x):
+        y = x.tocsr(copy=True)
+        y.data = posterior_probability(model, y.data)
+        return y
+
+    if out is None:
+        out = np.empty(x.shape, dtype=np.float64)
+    for start in range(0, x.shape[0], block):
+        out[start:start + block] = posterior_probability(
+            model, x[start:start + block])
+    return out
+
 
-    # load distance matrix and convert it to score
-    x = -np.load(distance_matrix)
+def do_train(distance_matrix, groundtruth_matrix, d2p_model,
+             nbins=100, sample=None):
 
-    # load groundtruth matrix
-    y = np.load(groundtruth_matrix)
+    # load (memory-mapped) distance and groundtruth matrices
+    x = load_matrix(distance_matrix, mmap_mode='r')
+    y = load_matrix(groundtruth_matrix, mmap_mode='r')
 
     # train isotonic regression
-    ir = LLRIsotonicRegression(equal_priors=True)
-    ir.fit(x, y)
+    model = train(x, y, nbins=nbins, sample=sample)
 
-    # save regression
-    with open(d2p_model, 'wb') as f:
-        pickle.dump(ir, f)
+    # save piecewise-linear model
+    save_model(d2p_model, model)
 
 
-def do_apply(distance_matrix, d2p_model, probability_matrix):
+def do_apply(distance_matrix, d2p_model, probability_matrix, block=BLOCK):
 
-    # load distance matrix and convert it to score
-    x = -np.load(distance_matrix)
+    # load (memory-mapped) distance matrix
+    x = load_matrix(distance_matrix, mmap_mode='r')
 
-    # load regression
-    with open(d2p_model, 'rb') as f:
-        ir = pickle.load(f)
+    # load model
+    model = load_model(d2p_model)
 
-    # apply isotonic regression
-    y = ir.toPosteriorProbability(x)
+    # apply model
+    # (only to stored entries in case of sparse matrix)
+    if scipy.sparse.issparse(x):
+        save_matrix(probability_matrix, apply_model(model, x))
+        return
 
-    # save probability matrix
-    np.save(probability_matrix, y)
+    # one block of rows at a time, into memory-mapped output
+    y = np.lib.format.open_memmap(probability_matrix, mode='w+',
+                                  dtype=np.float64, shape=x.shape)
+    apply_model(model, x, out=y, block=block)
+    y.flush()
 
 
 if __name__ == '__main__':
@@ -84,10 +345,18 @@ if __name__ == '__main__':
         distance_matrix = arguments['<distance_matrix>']
         groundtruth_matrix = arguments['<groundtruth_matrix>']
         d2p_model = arguments['<d2p_model>']
-        do_train(distance_matrix, groundtruth_matrix, d2p_model)
+        nbins = int(arguments['--bins'])
+        sample = arguments['--sample']
+        sample = None if sample is None else int(sample)
+        Cache().run(__file__, [distance_matrix, groundtruth_matrix],
+                    {'train': True, 'nbins': nbins, 'sample': sample},
+                    [d2p_model], do_train, distance_matrix,
+                    groundtruth_matrix, d2p_model, nbins=nbins, sample=sample)
 
     if arguments['apply']:
         distance_matrix = arguments['<distance_matrix>']
         d2p_model = arguments['<d2p_model>']
         probability_matrix = arguments['<probability_matrix>']
-        do_apply(distance_matrix, d2p_model, probability_matrix)
+        Cache().run(__file__, [distance_matrix, d2p_model], {'apply': True},
+                    [probability_matrix], do_apply, distance_matrix,
+                    d2p_model, probability_matrix)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License (MIT)
+
+# Copyright (c) 2014 Hervé BREDIN
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Generate geographic distance matrix between clusters
+
+The geographic distance between two clusters is the minimum great-circle
+distance between any of their geotagged images. Geotagged images are indexed
+in a KD-tree of 3D unit vectors -- where the chord length is a monotonic
+function of the great-circle distance -- so that only pairs of images closer
+than <radius> are ever compared.
+
+The output is a sparse K x K matrix (in sorted cluster order) that only
+contains pairs of clusters closer than <radius> (see hac.py). With --pairs,
+it only contains those also stored in <pairs.npz> (e.g. candidate pairs from
+candidates.py, so that clusters far apart in time are never merged).
+
+Usage:
+  geo.py [--radius=<km>] [--pairs=<pairs.npz>] <metadata.dir> <clustering.txt> <output.npz>
+  geo.py (-h | --help)
+  geo.py --version
+
+Options:
+  --radius=<km>        Only keep clusters closer than this distance [default: 1].
+  --pairs=<pairs.npz>  Only keep pairs stored in sparse matrix.
+  -h --help            Show this screen.
+  --version            Show version.
+
+"""
+
+from docopt import docopt
+from cache import Cache
+from candidates import restrict
+from clustering import CompactClustering
+from matrix import load_matrix, save_matrix
+from metadata import Metadata
+from scipy.spatial import cKDTree
+import scipy.sparse
+import numpy as np
+
+
+EARTH_RADIUS = 6371.
+
+
+def to_unit_vectors(latitude, longitude):
+    """Convert latitude and longitude (in degrees) to 3D unit vectors"""
+    latitude = np.radians(latitude)
+    longitude = np.radians(longitude)
+    return np.vstack([np.cos(latitude) * np.cos(longitude),
+                      np.cos(latitude) * np.sin(longitude),
+                      np.sin(latitude)]).T
+
+
+def chord_to_km(chord):
+    """Convert chord length between unit vectors to great-circle distance"""
+    return 2. * EARTH_RADIUS * np.arcsin(np.minimum(1., .5 * chord))
+
+
+def km_to_chord(km):
+    """Convert great-circle distance to chord length between unit vectors"""
+    return 2. * np.sin(np.minimum(.5 * np.pi, .5 * km / EARTH_RADIUS))
+
+
+class GeoIndex(object):
+    """Spatial index of geotagged images
+
+    Parameters
+    ----------
+    latitude, longitude : numpy arrays
+        Image coordinates in degrees. NaN for images that are not geotagged.
+    codes : numpy array
+        codes[i] is the index of the cluster containing image i
+        (or -1 if image i should be ignored).
+    n_clusters : int, optional
+        Number of clusters. Defaults to max(codes) + 1.
+
+    Usage
+    -----
+    >>> index = GeoIndex(latitude, longitude, codes)
+    >>> index.neighbours(3, 1.)   # clusters within 1km of cluster #3
+    >>> index.distance(3, 4)      # distance between clusters #3 and #4
+    >>> index.sparse_distance(1.) # K x K sparse distance matrix
+    """
+
+    def __init__(self, latitude, longitude, codes, n_clusters=None):
+        super(GeoIndex, self).__init__()
+
+        codes = np.asarray(codes)
+        if n_clusters is None:
+            n_clusters = np.max(codes) + 1
+        self.n_clusters = n_clusters
+
+        latitude, longitude = np.asarray(latitude), np.asarray(longitude)
+        keep = (codes >= 0) & ~np.isnan(latitude) & ~np.isnan(longitude)
+        codes = codes[keep]
+        latitude, longitude = latitude[keep], longitude[keep]
+
+        # geotagged images sorted by cluster. images of the same cluster
+        # sharing the same coordinates are only kept once (as they do not
+        # change single-linkage distances)
+        order = np.lexsort((longitude, latitude, codes))
+        codes, latitude, longitude = codes[order], latitude[order], \
+            longitude[order]
+        first = np.ones((len(codes), ), dtype=bool)
+        first[1:] = (codes[1:] != codes[:-1]) | \
+            (latitude[1:] != latitude[:-1]) | (longitude[1:] != longitude[:-1])
+
+        self.codes = codes[first]
+        self.points = to_unit_vectors(latitude[first], longitude[first])
+        self._starts = np.searchsorted(self.codes, np.arange(n_clusters + 1))
+
+        self.tree = cKDTree(self.points)
+
+        # per-cluster KD-trees, built on demand
+        self._trees = {}
+
+    def __len__(self):
+        return self.n_clusters
+
+    def _points(self, k):
+        return self.points[self._starts[k]:self._starts[k + 1]]
+
+    def _tree(self, k):
+        if k not in self._trees:
+            self._trees[k] = cKDTree(self._points(k))
+        return self._trees[k]
+
+    def neighbours(self, k, radius):
+        """Clusters (other than k) with an image within `radius` km of one
+        of the images of cluster k"""
+        points = self._points(k)
+        if len(points) == 0:
+            return np.empty((0, ), dtype=np.int64)
+        found = self.tree.query_ball_point(points, km_to_chord(radius))
+        found = np.unique(np.hstack([np.array(f, dtype=np.int64)
+                                     for f in found]))
+        neighbours = np.unique(self.codes[found])
+        return neighbours[neighbours != k]
+
+    def distance(self, u, v):
+        """Minimum great-circle distance (in km) between clusters u and v
+
+        Infinite if either cluster has no geotagged image.
+        """
+        points_u, points_v = self._points(u), self._points(v)
+        if len(points_u) == 0 or len(points_v) == 0:
+            return np.inf
+
+        # query the tree of the largest cluster with the smallest one
+        if len(points_u) > len(points_v):
+            u, v, points_u, points_v = v, u, points_v, points_u
+        chord, _ = self._tree(v).query(points_u, k=1)
+        return float(chord_to_km(np.min(chord)))
+
+    def _cross_pairs(self, radius):
+        """Pairs of images of different clusters closer than `radius` km
+
+        Clusters are recursively split into two halves (with about the same
+        number of images) and only pairs across halves are looked for, so
+        that pairs of images of the same cluster are never enumerated.
+        """
+
+        chord = km_to_chord(radius)
+        i, j = [np.empty((0, ), dtype=np.int64)], \
+            [np.empty((0, ), dtype=np.int64)]
+
+        ranges = [(0, self.n_clusters)]
+        while ranges:
+            k0, k1 = ranges.pop()
+            s0, s1 = self._starts[k0], self._starts[k1]
+            if k1 - k0 < 2 or s1 - s0 < 2:
+                continue
+
+            # split cluster range in two halves
+            m = np.searchsorted(self._starts, (s0 + s1) // 2)
+            m = min(max(m, k0 + 1), k1 - 1)
+            sm = self._starts[m]
+            ranges.extend([(k0, m), (m, k1)])
+
+            if sm == s0 or sm == s1:
+                continue
+            pairs = cKDTree(self.points[s0:sm]).sparse_distance_matrix(
+                cKDTree(self.points[sm:s1]), chord, output_type='ndarray')
+            i.append(s0 + pairs['i'].astype(np.int64))
+            j.append(sm + pairs['j'].astype(np.int64))
+
+        return np.hstack(i), np.hstack(j)
+
+    def sparse_distance(self, radius):
+        """Sparse K x K matrix of distances (in km) lower than `radius`
+
+        Clusters with at least one geotagged image are at distance 0 of
+        themselves.
+        """
+
+        K = self.n_clusters
+
+        # all pairs of images of different clusters closer than radius
+        i, j = self._cross_pairs(radius)
+        chord = np.sqrt(np.sum((self.points[i] - self.points[j]) ** 2,
+                               axis=1))
+        u, v = self.codes[i], self.codes[j]
+
+        # single linkage: min over all pairs of images of the same clusters
+        order = np.lexsort((chord, v, u))
+        u, v, chord = u[order], v[order], chord[order]
+        first = np.ones((len(u), ), dtype=bool)
+        first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+        u, v, distance = u[first], v[first], chord_to_km(chord[first])
+
+        # geotagged clusters are at distance 0 of themselves
+        diagonal = np.where(np.diff(self._starts) > 0)[0]
+
+        rows = np.hstack([u, v, diagonal])
+        cols = np.hstack([v, u, diagonal])
+        data = np.hstack([distance, distance, np.zeros((len(diagonal), ))])
+        return scipy.sparse.coo_matrix((data, (rows, cols)),
+                                       shape=(K, K)).tocsr()
+
+
+def do_it(metadata_dir, clustering_txt, output_npz, radius=1.,
+          pairs_npz=None):
+
+    metadata = Metadata(metadata_dir)
+
+    # load hypothesis clusters
+    clustering = CompactClustering.load(clustering_txt)
+    clusters = sorted(clustering.clusters)
+
+    # cluster index of every image
+    index = {cluster: c for c, cluster in enumerate(clusters)}
+    images = list(clustering)
+    codes = np.array([index[c] for c in clustering.to_list(images)],
+                     dtype=np.int64)
+
+    rows = metadata.index(images)
+    geo = GeoIndex(metadata.latitude[rows], metadata.longitude[rows], codes,
+                   n_clusters=len(clusters))
+
+    distance = geo.sparse_distance(radius)
+    if pairs_npz is not None:
+        distance = restrict(distance, load_matrix(pairs_npz))
+
+    save_matrix(output_npz, distance)
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    metadata_dir = arguments['<metadata.dir>']
+    clustering_txt = arguments['<clustering.txt>']
+    output_npz = arguments['<output.npz>']
+    radius = float(arguments['--radius'])
+    pairs_npz = arguments['--pairs']
+
+    Cache().run(__file__, [metadata_dir, clustering_txt, pairs_npz],
+                {'radius': radius}, [output_npz],
+                do_it, metadata_dir, clustering_txt, output_npz,
+                radius=radius, pairs_npz=pairs_npz)
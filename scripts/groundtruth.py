@@ -31,61 +31,171 @@ reference cluster, G[i, j] = 0 if they are in two different reference clusters
 and G[i, j] = -1 if at least one of pre-clusters i and j are already not
 completely pure.
 
+The dense matrix is saved as int8. With --upper, only its strict upper
+triangle is saved, as a condensed vector of K (K - 1) / 2 entries, in the
+same order as scipy.spatial.distance.squareform.
+
+When a sparse K x K matrix (.npz, e.g. a sparse distance matrix or candidate
+pairs from candidates.py) is provided with --pairs, G is only computed for
+the pairs stored in this matrix and is saved as a sparse .npz matrix with the
+same structure.
+
 Usage:
-  groundtruth.py <reference.txt> <pre_clustering.txt> <groundtruth.npy>
+  groundtruth.py [--pairs=<pairs.npz> | --upper] <reference.txt> <pre_clustering.txt> <groundtruth>
   groundtruth.py (-h | --help)
   groundtruth.py --version
 
 Options:
-  -h --help     Show this screen.
-  --version     Show version.
+  --pairs=<pairs.npz>  Only compute groundtruth for pairs stored in sparse matrix.
+  --upper              Only save strict upper triangle (condensed vector).
+  -h --help            Show this screen.
+  --version            Show version.
 
 """
 from docopt import docopt
-from clustering import Clustering
+from cache import Cache
+from clustering import CompactClustering
+from matrix import load_matrix, save_matrix, upper_offset
+import scipy.sparse
 import numpy as np
 
 
-def do_compute(reference_txt, pre_clustering_txt, groundtruth_npy):
-
-    # load reference clusters
-    reference = Clustering.load(reference_txt)
-
-    # load hypothesis clusters
-    hypothesis = Clustering.load(pre_clustering_txt)
+# number of rows processed at once
+BLOCK = 1024
+
+
+def pure_references(reference, hypothesis, preClusters):
+    """Reference cluster of each pure pre-cluster
+
+    Parameters
+    ----------
+    reference, hypothesis : CompactClustering
+    preClusters : list
+        Sorted pre-cluster labels.
+
+    Returns
+    -------
+    refs : numpy array
+        refs[k] is the index of the reference cluster containing all items of
+        pre-cluster preClusters[k], or -1 if this pre-cluster is not pure.
+    """
+
+    # pre-cluster index and reference cluster index of every item
+    items = list(hypothesis)
+    index = {cluster: k for k, cluster in enumerate(preClusters)}
+    codes = np.array([index[c] for c in hypothesis.to_list(items)],
+                     dtype=np.int64)
+    _, labels = np.unique(reference.to_list(items), return_inverse=True)
+
+    # pre-cluster is pure if all its items share the same reference cluster
+    K = len(preClusters)
+    lo = np.empty((K, ), dtype=np.int64)
+    lo.fill(np.iinfo(np.int64).max)
+    hi = -np.ones((K, ), dtype=np.int64)
+    np.minimum.at(lo, codes, labels)
+    np.maximum.at(hi, codes, labels)
+
+    return np.where(lo == hi, lo, -1)
+
+
+def groundtruth_block(refs, rows, cols):
+    """Groundtruth between pre-clusters rows and pre-clusters cols"""
+    r, c = refs[rows], refs[cols]
+    block = (r[:, np.newaxis] == c).astype(np.int8)
+    block[r < 0, :] = -1
+    block[:, c < 0] = -1
+    return block
+
+
+def groundtruth_matrix(reference, hypothesis, pairs=None, upper=False,
+                       out=None, block=BLOCK):
+    """Groundtruth matrix between (sorted) pre-clusters
+
+    Parameters
+    ----------
+    reference, hypothesis : CompactClustering
+    pairs : scipy sparse matrix, optional
+        Only compute groundtruth for pairs stored in this K x K matrix.
+    upper : bool, optional
+        Only compute strict upper triangle (condensed vector).
+    out : numpy array, optional
+        Where to write dense groundtruth (e.g. a memory-mapped array).
+    block : int, optional
+        Number of rows processed at once.
+
+    Returns
+    -------
+    groundtruth : numpy array or scipy sparse matrix
+        int8 (K, K) matrix, condensed K (K - 1) / 2 vector (when upper is
+        True) or sparse matrix (when pairs is provided).
+    """
 
     # number of hypothesis clusters
     nPreClusters = len(hypothesis.clusters)
     preClusters = sorted(hypothesis.clusters)
 
+    # refs[k] is the reference cluster of pure pre-cluster k (-1 if impure)
+    refs = pure_references(reference, hypothesis, preClusters)
+
+    if pairs is not None:
+        pairs = pairs.tocoo()
+        r, c = refs[pairs.row], refs[pairs.col]
+        data = np.where((r < 0) | (c < 0), -1, r == c).astype(np.int8)
+        return scipy.sparse.coo_matrix(
+            (data, (pairs.row, pairs.col)), shape=pairs.shape).tocsr()
+
+    K = nPreClusters
+
     # groundtruth[i, j] contains
     # 1 if all elements in clusters i and j are in the same cluster
     # 0 if elements in clusters i and j are not in the same cluster
     # -1 if either cluster i or j is not pure
-    groundtruth = np.empty((nPreClusters, nPreClusters), dtype=int)
-
-    # clustersRef[c] contains reference cluster for pure hypothesis cluster c
-    # in case c is not pure, clustersRef[c] is None
-    clustersRef = {}
-    for c in preClusters:
-        r = set([reference[i] for i in hypothesis.clusters[c]])
-        if len(r) == 1:
-            clustersRef[c] = r.pop()
-        else:
-            clustersRef[c] = None
-
-    for k, ci in enumerate(preClusters):
-        if clustersRef[ci] is None:
-            groundtruth[ci, :] = -1
-            groundtruth[:, ci] = -1
+    if out is None:
+        shape = (K * (K - 1) // 2, ) if upper else (K, K)
+        out = np.empty(shape, dtype=np.int8)
+
+    # one block of rows at a time
+    for start in range(0, K, block):
+        stop = min(K, start + block)
+        rows = np.arange(start, stop)
+        if not upper:
+            out[start:stop] = groundtruth_block(refs, rows, np.arange(K))
             continue
-        for cj in preClusters[k:]:
-            if clustersRef[cj] is not None:
-                groundtruth[ci, cj] = clustersRef[ci] == clustersRef[cj]
-                groundtruth[cj, ci] = groundtruth[ci, cj]
+        # strictly upper part of rows start to stop
+        G = groundtruth_block(refs, rows, np.arange(start, K))
+        mask = np.arange(start, K)[np.newaxis, :] > rows[:, np.newaxis]
+        out[upper_offset(K, start):upper_offset(K, stop)] = G[mask]
+
+    return out
+
+
+def do_compute(reference_txt, pre_clustering_txt, groundtruth_npy,
+               pairs_npz=None, upper=False, block=BLOCK):
+
+    # load reference clusters
+    reference = CompactClustering.load(reference_txt)
+
+    # load hypothesis clusters
+    hypothesis = CompactClustering.load(pre_clustering_txt)
+
+    if pairs_npz is not None:
+        pairs = load_matrix(pairs_npz)
+        groundtruth = groundtruth_matrix(reference, hypothesis, pairs=pairs)
+        save_matrix(groundtruth_npy, groundtruth)
+        return
+
+    # write directly into memory-mapped output
+    K = len(hypothesis.clusters)
+    if upper:
+        shape = (K * (K - 1) // 2, )
+    else:
+        shape = (K, K)
+    groundtruth = np.lib.format.open_memmap(groundtruth_npy, mode='w+',
+                                            dtype=np.int8, shape=shape)
+    groundtruth_matrix(reference, hypothesis, upper=upper, out=groundtruth,
+                       block=block)
+    groundtruth.flush()
 
-    # save groundtruth matrix
-    np.save(groundtruth_npy, groundtruth)
 
 if __name__ == '__main__':
 
@@ -93,5 +203,9 @@ if __name__ == '__main__':
 
     reference = arguments['<reference.txt>']
     clustering = arguments['<pre_clustering.txt>']
-    groundtruth = arguments['<groundtruth.npy>']
-    do_compute(reference, clustering, groundtruth)
+    groundtruth = arguments['<groundtruth>']
+    pairs = arguments['--pairs']
+    upper = arguments['--upper']
+    Cache().run(__file__, [reference, clustering, pairs], {'upper': upper},
+                [groundtruth], do_compute, reference, clustering, groundtruth,
+                pairs_npz=pairs, upper=upper)
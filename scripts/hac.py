@@ -0,0 +1,687 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License (MIT)
+
+# Copyright (c) 2014 Hervé BREDIN
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Single-linkage hierarchical clustering of pre-clusters
+
+The distance between two clusters is the minimum distance between their
+images: d(w, v') = min dist(w[i], v'[j]). Clusters are merged as long as
+their distance is lower than or equal to <theta>.
+
+The (symmetric) distance matrix is either given between pre-clusters
+(K x K, in sorted pre-cluster order, as produced by cluster_distance.py) or
+between images (N x N, in the order of --images list, as produced by
+computeMatrix.py). It can be dense (.npy) or sparse (.npz), in which case
+missing entries are considered infinite. So are NaN entries.
+
+With --method=mst (default), the dendrogram is obtained from the minimum
+spanning tree of the cluster graph (Prim's algorithm), in O(K^2) time and O(K)
+extra memory.
+
+With --method=heap, the dendrogram is never built: only the E edges whose
+distance is lower than or equal to <theta> are extracted from the matrix (one
+block of rows at a time) and popped in ascending order from a priority queue
+into a union-find forest, in O(E log E). This is much faster with sparse
+matrices (e.g. from --top or --pairs options of other scripts). Both methods
+return the same clusters.
+
+`tree` saves the whole dendrogram as a scipy-compatible linkage matrix (see
+scipy.cluster.hierarchy.linkage) along with the sorted pre-cluster labels, in
+a small .npz file. Disconnected components are merged at infinite height.
+With --method=heap and a sparse matrix, the minimum spanning tree is
+obtained with Kruskal's algorithm over its stored entries, in O(E log E).
+Dense matrices always use Prim's algorithm (which never materializes their
+K^2 / 2 edges).
+
+`cut` then forms flat clusters at every comma-separated threshold in
+<thetas> (same as `cluster`), in a single pass over the linkage and O(K) per
+threshold. One output file per threshold is saved ({theta} in <output> is
+replaced by the threshold) and, with --reference, the score-vs-theta curve
+is printed.
+
+Usage:
+  hac.py cluster [--method=<method>] [--images=<image.txt>] <pre_clustering.txt> <distance> <theta> <output.txt>
+  hac.py tree [--method=<method>] [--images=<image.txt>] <pre_clustering.txt> <distance> <tree.npz>
+  hac.py cut [--reference=<reference.txt>] <pre_clustering.txt> <tree.npz> <thetas> <output>
+  hac.py (-h | --help)
+  hac.py --version
+
+Options:
+  --method=<method>            mst or heap [default: mst].
+  --images=<image.txt>         Distance matrix is between images listed in
+                               this file.
+  --reference=<reference.txt>  Evaluate clusters against this reference.
+  -h --help                    Show this screen.
+  --version                    Show version.
+
+"""
+
+from docopt import docopt
+from cache import Cache
+from clustering import Clustering, CompactClustering
+from matrix import load_matrix
+from metrics import align, contingency, scores
+import scipy.sparse
+import numpy as np
+import heapq
+import os
+
+
+# size of square tiles processed at once when extracting edges from dense
+# matrices
+BLOCK = 1024
+
+METHODS = ['mst', 'heap']
+
+
+class ClusterDistance(object):
+    """Single-linkage distance between clusters, one row at a time
+
+    Parameters
+    ----------
+    matrix : numpy array or scipy sparse matrix
+        Symmetric distance matrix, either between clusters or between images.
+        Missing (sparse) and NaN entries are considered infinite.
+    codes : numpy array, optional
+        When `matrix` is between images, codes[i] is the index of the cluster
+        containing image i (or -1 if image i should be ignored).
+    n_clusters : int, optional
+        Number of clusters. Defaults to the size of `matrix`.
+    """
+
+    def __init__(self, matrix, codes=None, n_clusters=None):
+        super(ClusterDistance, self).__init__()
+
+        if scipy.sparse.issparse(matrix):
+            matrix = matrix.tocsr()
+        self.matrix = matrix
+
+        if n_clusters is None:
+            n_clusters = matrix.shape[0] if codes is None else np.max(codes) + 1
+        self.n_clusters = n_clusters
+
+        self.codes = None if codes is None else np.asarray(codes)
+
+        if self.codes is not None:
+            # images sorted by cluster
+            self._order = np.argsort(self.codes, kind='mergesort')
+            sorted_codes = self.codes[self._order]
+            self._order = self._order[sorted_codes >= 0]
+            sorted_codes = sorted_codes[sorted_codes >= 0]
+            self._starts = np.searchsorted(sorted_codes,
+                                           np.arange(n_clusters + 1))
+            self._present = np.diff(self._starts) > 0
+
+    def __len__(self):
+        return self.n_clusters
+
+    def members(self, k):
+        """Indices of images in cluster k"""
+        return self._order[self._starts[k]:self._starts[k + 1]]
+
+    def row(self, k):
+        """Distance between cluster k and all clusters"""
+
+        K = self.n_clusters
+        matrix = self.matrix
+
+        if self.codes is None:
+            if scipy.sparse.issparse(matrix):
+                row = np.inf * np.ones((K, ))
+                start, stop = matrix.indptr[k], matrix.indptr[k + 1]
+                row[matrix.indices[start:stop]] = matrix.data[start:stop]
+            else:
+                row = np.array(matrix[k], dtype=np.float64)
+            row[np.isnan(row)] = np.inf
+            return row
+
+        members = self.members(k)
+        row = np.inf * np.ones((K, ))
+
+        if scipy.sparse.issparse(matrix):
+            sub = matrix[members].tocoo()
+            codes = self.codes[sub.col]
+            keep = (codes >= 0) & ~np.isnan(sub.data)
+            np.minimum.at(row, codes[keep], sub.data[keep])
+            return row
+
+        if len(members):
+            # images sorted by cluster, then min over each cluster
+            sub = np.array(matrix[members][:, self._order], dtype=np.float64)
+            sub[np.isnan(sub)] = np.inf
+            sub = np.min(sub, axis=0)
+            present = self._present
+            row[present] = np.minimum.reduceat(sub,
+                                               self._starts[:-1][present])
+        return row
+
+
+def minimum_spanning_tree(distance):
+    """Minimum spanning tree of clusters (Prim's algorithm)
+
+    Parameters
+    ----------
+    distance : ClusterDistance
+
+    Returns
+    -------
+    edges : (K - 1, 3) numpy array
+        Each row (i, j, d) is an edge between clusters i and j at distance d.
+        Disconnected components are linked with infinite distance edges.
+    """
+
+    K = len(distance)
+    edges = np.empty((max(0, K - 1), 3))
+
+    in_tree = np.zeros((K, ), dtype=bool)
+    best = np.inf * np.ones((K, ))
+    parent = np.zeros((K, ), dtype=np.int64)
+
+    current = 0
+    in_tree[current] = True
+    for e in range(K - 1):
+
+        row = distance.row(current)
+        update = (row < best) & ~in_tree
+        best[update] = row[update]
+        parent[update] = current
+
+        # closest cluster not in the tree
+        candidates = np.where(~in_tree)[0]
+        current = candidates[np.argmin(best[candidates])]
+
+        edges[e] = parent[current], current, best[current]
+        in_tree[current] = True
+
+    return edges
+
+
+def _find(parent, k):
+    """Root of k in union-find forest (with path halving)"""
+    while parent[k] != k:
+        parent[k] = parent[parent[k]]
+        k = parent[k]
+    return k
+
+
+def _labels(parent):
+    """Flat cluster of every node of union-find forest, numbered by order of
+    their first node"""
+    roots = np.array([_find(parent, k) for k in range(len(parent))],
+                     dtype=np.int64)
+    _, labels = np.unique(roots, return_inverse=True)
+    return labels
+
+
+def flat_clusters(edges, n_clusters, theta):
+    """Flat clusters obtained by merging edges with distance <= theta
+
+    Returns
+    -------
+    labels : numpy array
+        labels[k] is the flat cluster of (pre-)cluster k. Flat clusters are
+        numbered by order of their first (pre-)cluster.
+    """
+
+    # union-find over clusters
+    parent = range(n_clusters)
+
+    for i, j, d in edges:
+        if d <= theta:
+            i, j = _find(parent, int(i)), _find(parent, int(j))
+            parent[max(i, j)] = min(i, j)
+
+    return _labels(parent)
+
+
+def threshold_edges(matrix, theta, codes=None, block=BLOCK):
+    """Edges between clusters with distance lower than or equal to theta
+
+    Parameters
+    ----------
+    matrix : numpy array or scipy sparse matrix
+        Symmetric distance matrix, either between clusters or between images
+        (see ClusterDistance). Only its upper triangle is read. Missing
+        (sparse) and NaN entries are ignored.
+    theta : float
+    codes : numpy array, optional
+        When `matrix` is between images, codes[i] is the index of the cluster
+        containing image i (or -1 if image i should be ignored).
+    block : int, optional
+        Dense matrices are processed by (block x block) tiles.
+
+    Returns
+    -------
+    distance, rows, cols : numpy arrays
+        Edges between clusters rows[e] and cols[e] (rows[e] != cols[e]),
+        possibly more than once in case of matrix between images.
+    """
+
+    if codes is not None:
+        codes = np.asarray(codes)
+
+    distances, rows, cols = [], [], []
+
+    def append(d, r, c):
+        # edges between images are mapped to edges between their clusters
+        if codes is not None:
+            r, c = codes[r], codes[c]
+            keep = (r >= 0) & (c >= 0) & (r != c)
+            d, r, c = d[keep], r[keep], c[keep]
+        distances.append(d)
+        rows.append(r)
+        cols.append(c)
+
+    if scipy.sparse.issparse(matrix):
+        matrix = matrix.tocoo()
+        # NaN <= theta is False
+        with np.errstate(invalid='ignore'):
+            keep = (matrix.row < matrix.col) & (matrix.data <= theta)
+        append(matrix.data[keep], matrix.row[keep].astype(np.int64),
+               matrix.col[keep].astype(np.int64))
+
+    else:
+        # tiles of the upper triangle only
+        N = matrix.shape[0]
+        for i in range(0, N, block):
+            for j in range(i, N, block):
+                sub = np.array(matrix[i:i + block, j:j + block],
+                               dtype=np.float64)
+                with np.errstate(invalid='ignore'):
+                    r, c = np.where(sub <= theta)
+                if i == j:
+                    upper = c > r
+                    r, c = r[upper], c[upper]
+                append(sub[r, c], i + r, j + c)
+
+    if not distances:
+        return (np.empty((0, )), np.empty((0, ), dtype=np.int64),
+                np.empty((0, ), dtype=np.int64))
+    return tuple(np.hstack(x) for x in (distances, rows, cols))
+
+
+def heap_clusters(edges, n_clusters, theta):
+    """Flat clusters obtained by merging edges in ascending distance order
+
+    Parameters
+    ----------
+    edges : (distance, rows, cols) tuple of numpy arrays
+        See threshold_edges.
+    n_clusters : int
+    theta : float
+
+    Returns
+    -------
+    labels : numpy array
+        Same as flat_clusters.
+    """
+
+    distance, rows, cols = edges
+    heap = zip(distance.tolist(), rows.tolist(), cols.tolist())
+    heapq.heapify(heap)
+
+    # union-find over clusters
+    parent = range(n_clusters)
+    n_components = n_clusters
+
+    while heap and n_components > 1:
+        d, i, j = heapq.heappop(heap)
+        if d > theta:
+            break
+        i, j = _find(parent, i), _find(parent, j)
+        if i != j:
+            parent[max(i, j)] = min(i, j)
+            n_components -= 1
+
+    return _labels(parent)
+
+
+def spanning_edges(edges, n_clusters):
+    """Minimum spanning forest (Kruskal's algorithm)
+
+    Parameters
+    ----------
+    edges : (distance, rows, cols) tuple of numpy arrays
+        See threshold_edges.
+    n_clusters : int
+
+    Returns
+    -------
+    edges : (K - 1, 3) numpy array
+        Same as minimum_spanning_tree.
+    """
+
+    distance, rows, cols = edges
+    order = np.argsort(distance, kind='mergesort')
+
+    parent = range(n_clusters)
+    tree = []
+    for e in order.tolist():
+        i, j = _find(parent, int(rows[e])), _find(parent, int(cols[e]))
+        if i != j:
+            parent[max(i, j)] = min(i, j)
+            tree.append((rows[e], cols[e], distance[e]))
+            if len(tree) == n_clusters - 1:
+                break
+
+    # link disconnected components with infinite distance edges
+    roots = sorted(set(_find(parent, k) for k in range(n_clusters)))
+    for root in roots[1:]:
+        tree.append((roots[0], root, np.inf))
+
+    return np.array(tree, dtype=np.float64).reshape((-1, 3))
+
+
+def linkage(edges, n_clusters):
+    """Linkage matrix from minimum spanning tree edges
+
+    Parameters
+    ----------
+    edges : (K - 1, 3) numpy array
+        See minimum_spanning_tree.
+    n_clusters : int
+
+    Returns
+    -------
+    Z : (K - 1, 4) numpy array
+        Same format as scipy.cluster.hierarchy.linkage: at step s, clusters
+        Z[s, 0] and Z[s, 1] (leaves are 0 to K - 1) are merged at height
+        Z[s, 2] into cluster K + s, containing Z[s, 3] leaves.
+    """
+
+    order = np.argsort(edges[:, 2], kind='mergesort')
+
+    # union-find over leaves, and current linkage cluster of every root
+    parent = range(n_clusters)
+    node = range(n_clusters)
+    size = [1] * n_clusters
+
+    Z = np.empty((len(order), 4))
+    for s, e in enumerate(order.tolist()):
+        i, j, d = edges[e]
+        i, j = _find(parent, int(i)), _find(parent, int(j))
+        a, b = sorted([node[i], node[j]])
+        root, other = min(i, j), max(i, j)
+        parent[other] = root
+        size[root] += size[other]
+        node[root] = n_clusters + s
+        Z[s] = a, b, d, size[root]
+
+    return Z
+
+
+def cut(Z, n_clusters, thetas):
+    """Flat clusters at every threshold, in a single pass over the linkage
+
+    Parameters
+    ----------
+    Z : numpy array
+        Linkage matrix (see linkage).
+    n_clusters : int
+    thetas : iterable
+        Thresholds.
+
+    Yields
+    ------
+    theta : float
+    labels : numpy array
+        Same as flat_clusters, for every threshold (in ascending order).
+    """
+
+    # union-find over leaves, and one leaf of every linkage cluster
+    parent = range(n_clusters)
+    leaf = range(n_clusters) + [None] * len(Z)
+
+    s = 0
+    for theta in sorted(thetas):
+        while s < len(Z) and Z[s, 2] <= theta:
+            a, b = leaf[int(Z[s, 0])], leaf[int(Z[s, 1])]
+            i, j = _find(parent, a), _find(parent, b)
+            parent[max(i, j)] = min(i, j)
+            leaf[n_clusters + s] = min(i, j)
+            s += 1
+        yield theta, _labels(parent)
+
+
+def _image_codes(pre_clustering, preClusters, images):
+    """Index of pre-cluster containing every image (-1 if none)"""
+    index = {cluster: c for c, cluster in enumerate(preClusters)}
+    return np.array([index[pre_clustering[image]]
+                     if image in pre_clustering else -1
+                     for image in images], dtype=np.int64)
+
+
+def _propagate(pre_clustering, preClusters, labels):
+    """Propagate flat cluster labels of pre-clusters to images"""
+    clustering = Clustering()
+    for c, label in enumerate(preClusters):
+        for image in pre_clustering.clusters[label]:
+            clustering[image] = int(labels[c])
+    return clustering
+
+
+def tree(pre_clustering, matrix, images=None, method='mst'):
+    """Single-linkage dendrogram of pre-clusters
+
+    Parameters
+    ----------
+    pre_clustering : CompactClustering
+    matrix : numpy array or scipy sparse matrix
+        Distance matrix, between (sorted) pre-clusters or between images.
+    images : list, optional
+        When `matrix` is between images, images in matrix order.
+    method : {'mst', 'heap'}, optional
+        Prim's algorithm (default) or Kruskal's algorithm over stored entries
+        of sparse matrices. Dense matrices always use Prim's algorithm.
+
+    Returns
+    -------
+    Z : numpy array
+        Linkage matrix (see linkage).
+    """
+
+    preClusters = sorted(pre_clustering.clusters)
+    K = len(preClusters)
+
+    codes = None
+    if images is not None:
+        codes = _image_codes(pre_clustering, preClusters, images)
+
+    # Kruskal's algorithm would sort every edge of dense matrices
+    if method == 'heap' and scipy.sparse.issparse(matrix):
+        edges = spanning_edges(threshold_edges(matrix, np.inf, codes=codes), K)
+    else:
+        edges = minimum_spanning_tree(
+            ClusterDistance(matrix, codes=codes, n_clusters=K))
+
+    return linkage(edges, K)
+
+
+def cluster(pre_clustering, matrix, theta, images=None, method='mst'):
+    """Single-linkage clustering of pre-clusters
+
+    Parameters
+    ----------
+    pre_clustering : CompactClustering
+    matrix : numpy array or scipy sparse matrix
+        Distance matrix, between (sorted) pre-clusters or between images.
+    theta : float
+        Merge clusters as long as their distance is lower than or equal to
+        theta.
+    images : list, optional
+        When `matrix` is between images, images in matrix order.
+    method : {'mst', 'heap'}, optional
+        Minimum spanning tree (default) or priority queue of edges lower
+        than theta. Both return the same clusters.
+
+    Returns
+    -------
+    clustering : Clustering
+    """
+
+    preClusters = sorted(pre_clustering.clusters)
+
+    codes = None
+    if images is not None:
+        codes = _image_codes(pre_clustering, preClusters, images)
+
+    if method == 'heap':
+        edges = threshold_edges(matrix, theta, codes=codes)
+        labels = heap_clusters(edges, len(preClusters), theta)
+
+    else:
+        distance = ClusterDistance(matrix, codes=codes,
+                                   n_clusters=len(preClusters))
+        edges = minimum_spanning_tree(distance)
+        labels = flat_clusters(edges, len(preClusters), theta)
+
+    return _propagate(pre_clustering, preClusters, labels)
+
+
+def _load_images(image_txt):
+    if image_txt is None:
+        return None
+    with open(image_txt, 'r') as f:
+        return [int(line.strip()) for line in f.readlines()]
+
+
+def do_cluster(pre_clustering_txt, distance_matrix, theta, output_txt,
+               image_txt=None, method='mst'):
+
+    # load pre-clusters
+    pre_clustering = CompactClustering.load(pre_clustering_txt)
+
+    # load distance matrix
+    matrix = load_matrix(distance_matrix, mmap_mode='r')
+
+    clustering = cluster(pre_clustering, matrix, theta,
+                         images=_load_images(image_txt), method=method)
+
+    clustering.save(output_txt)
+
+    return clustering
+
+
+def do_tree(pre_clustering_txt, distance_matrix, tree_npz, image_txt=None,
+            method='mst'):
+
+    # load pre-clusters
+    pre_clustering = CompactClustering.load(pre_clustering_txt)
+
+    # load distance matrix
+    matrix = load_matrix(distance_matrix, mmap_mode='r')
+
+    Z = tree(pre_clustering, matrix, images=_load_images(image_txt),
+             method=method)
+
+    # file object so that numpy does not append .npz extension
+    with open(tree_npz, 'wb') as f:
+        np.savez(f, linkage=Z,
+                 ids=np.array(sorted(pre_clustering.clusters), dtype=np.int64))
+
+
+def outputFile(output, theta):
+    if '{theta}' in output:
+        return output.format(theta=theta)
+    root, ext = os.path.splitext(output)
+    return '%s_%s%s' % (root, theta, ext)
+
+
+def do_cut(pre_clustering_txt, tree_npz, thetas, output, reference_txt=None):
+
+    # load pre-clusters
+    pre_clustering = CompactClustering.load(pre_clustering_txt)
+    preClusters = sorted(pre_clustering.clusters)
+
+    # load linkage
+    with np.load(tree_npz) as data:
+        Z, ids = data['linkage'], data['ids']
+    if ids.tolist() != preClusters:
+        raise ValueError('%s was not obtained from %s' % (tree_npz,
+                                                         pre_clustering_txt))
+
+    if reference_txt is not None:
+        # pre-cluster index of every image found in reference
+        reference = CompactClustering.load(reference_txt)
+        index = {cluster: c for c, cluster in enumerate(preClusters)}
+        items, labels = pre_clustering.to_arrays()
+        codes = np.array([index[label] for label in labels.tolist()],
+                         dtype=np.int64)
+        reference_codes, codes = align(
+            reference, CompactClustering.from_arrays(items, codes))
+        print "theta\tclusters\thomogeneity\tcompleteness"
+
+    for theta, labels in cut(Z, len(preClusters), thetas):
+
+        clustering = _propagate(pre_clustering, preClusters, labels)
+        clustering.save(outputFile(output, theta))
+
+        if reference_txt is not None:
+            result = scores(contingency(reference_codes, labels[codes]))
+            print "%g\t%d\t%.4f\t%.4f" % (
+                theta, np.max(labels) + 1 if len(labels) else 0,
+                result['homogeneity'], result['completeness'])
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    if arguments['cluster']:
+        pre_clustering_txt = arguments['<pre_clustering.txt>']
+        distance_matrix = arguments['<distance>']
+        theta = float(arguments['<theta>'])
+        output_txt = arguments['<output.txt>']
+        image_txt = arguments['--images']
+        method = arguments['--method']
+        if method not in METHODS:
+            raise ValueError('unknown method "%s"' % method)
+        # both methods return the same clusters
+        Cache().run(__file__, [pre_clustering_txt, distance_matrix, image_txt],
+                    {'theta': theta}, [output_txt],
+                    do_cluster, pre_clustering_txt, distance_matrix, theta,
+                    output_txt, image_txt=image_txt, method=method)
+
+    if arguments['tree']:
+        pre_clustering_txt = arguments['<pre_clustering.txt>']
+        distance_matrix = arguments['<distance>']
+        tree_npz = arguments['<tree.npz>']
+        image_txt = arguments['--images']
+        method = arguments['--method']
+        if method not in METHODS:
+            raise ValueError('unknown method "%s"' % method)
+        # linkage may differ in case of ties, hence method is part of the key
+        Cache().run(__file__, [pre_clustering_txt, distance_matrix, image_txt],
+                    {'tree': True, 'method': method}, [tree_npz],
+                    do_tree, pre_clustering_txt, distance_matrix, tree_npz,
+                    image_txt=image_txt, method=method)
+
+    if arguments['cut']:
+        pre_clustering_txt = arguments['<pre_clustering.txt>']
+        tree_npz = arguments['<tree.npz>']
+        thetas = [float(theta) for theta in arguments['<thetas>'].split(',')]
+        output = arguments['<output>']
+        reference_txt = arguments['--reference']
+        do_cut(pre_clustering_txt, tree_npz, thetas, output,
+               reference_txt=reference_txt)
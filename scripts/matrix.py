@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License (MIT)
+
+# Copyright (c) 2014 Hervé BREDIN
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Load and save dense (.npy) or sparse (.npz) matrices
+
+Sparse matrices are scipy.sparse CSR matrices saved with `save_npz`.
+They only store a selection of pairs (e.g. those below a distance cutoff).
+Stored entries may be explicit zeros (a zero distance is a valid distance)
+and absent entries mean the pair was not selected -- not that its value is 0.
+
+Symmetric matrices may also be saved as the condensed vector of their strict
+upper triangle (.npy, same order as scipy.spatial.distance.squareform).
+"""
+
+import numpy as np
+import scipy.sparse
+
+
+def load_matrix(path, mmap_mode=None):
+    """Load dense .npy matrix (possibly memory-mapped) or sparse .npz matrix"""
+    if path.endswith('.npz'):
+        return scipy.sparse.load_npz(path)
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def save_matrix(path, matrix):
+    """Save sparse matrix to .npz or dense matrix to .npy"""
+    if scipy.sparse.issparse(matrix):
+        scipy.sparse.save_npz(path, matrix.tocsr(), compressed=False)
+    else:
+        np.save(path, matrix)
+
+
+def get_entries(matrix, rows, cols):
+    """Get matrix[rows[k], cols[k]] for all k, as a 1-dimensional array"""
+    if scipy.sparse.issparse(matrix):
+        return np.asarray(matrix.tocsr()[rows, cols]).reshape((-1, ))
+    return np.asarray(matrix[rows, cols])
+
+
+def upper_offset(n, i):
+    """Position of entry (i, i + 1) in condensed upper triangle of n x n matrix
+
+    Entries (i, j > i) of row i are stored contiguously from this position.
+    """
+    return i * n - i * (i + 1) // 2
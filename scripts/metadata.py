@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License (MIT)
+
+# Copyright (c) 2014 Hervé BREDIN
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Convert JSON metadata into a memory-mapped columnar store
+
+The store is a directory with one file per column, all rows sorted by photoID:
+
+  photoID.npy        int64    Flickr photo ID
+  username.npy       int32    username code (index in usernames.txt)
+  usernames.txt               one username per line
+  dateTaken.npy      int64    'dateTaken' as seconds since epoch
+  latitude.npy       float64  NaN when photo is not geotagged
+  longitude.npy      float64  NaN when photo is not geotagged
+  geotagged.npy      bool
+  title.npy          int64    (start, stop) byte offsets into title.txt
+  description.npy    int64    (start, stop) byte offsets into description.txt
+  tags.npy           int64    (start, stop) byte offsets into tags.txt
+
+Usage:
+  metadata.py <metadata.json> <metadata.dir>
+  metadata.py (-h | --help)
+  metadata.py --version
+
+Options:
+  -h --help     Show this screen.
+  --version     Show version.
+
+"""
+
+from docopt import docopt
+from cache import Cache
+from datetime import datetime
+import simplejson as json
+import numpy as np
+import calendar
+import codecs
+import mmap
+import os
+
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+TEXT_FIELDS = ['title', 'description', 'tags']
+
+
+def parse_date(dateTaken):
+    """Convert 'dateTaken' string to seconds since epoch"""
+    return calendar.timegm(
+        datetime.strptime(dateTaken, DATE_FORMAT).utctimetuple())
+
+
+class Metadata(object):
+    """Memory-mapped columnar metadata store
+
+    Columns are only loaded (memory-mapped) when first accessed.
+
+    >>> metadata = Metadata('/vol/corpora4/mediaeval/2014/SED_2014_Dev_Metadata')
+    >>> rows = metadata.index([2988688829, 958183223])
+    >>> metadata.dateTaken[rows]
+    array([1186837800, 1193482983])
+    >>> metadata.text('title', rows[0])
+    u'...'
+    """
+
+    def __init__(self, path):
+        super(Metadata, self).__init__()
+        self.path = path
+        self._columns = {}
+        self._usernames = None
+        self._blobs = {}
+
+    def column(self, name):
+        if name not in self._columns:
+            self._columns[name] = np.load(
+                os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self._columns[name]
+
+    photoID = property(lambda self: self.column('photoID'))
+    username = property(lambda self: self.column('username'))
+    dateTaken = property(lambda self: self.column('dateTaken'))
+    latitude = property(lambda self: self.column('latitude'))
+    longitude = property(lambda self: self.column('longitude'))
+    geotagged = property(lambda self: self.column('geotagged'))
+
+    @property
+    def usernames(self):
+        if self._usernames is None:
+            path = os.path.join(self.path, 'usernames.txt')
+            with codecs.open(path, 'r', encoding='utf8') as f:
+                self._usernames = [line.rstrip(u'\n') for line in f]
+        return self._usernames
+
+    def __len__(self):
+        return len(self.photoID)
+
+    def index(self, photos):
+        """Get row indices of photos
+
+        Raises KeyError for the first photo missing from the store.
+        """
+        photos = np.asarray(photos, dtype=np.int64)
+        photoID = self.photoID
+        rows = np.searchsorted(photoID, photos)
+        rows[rows == len(photoID)] = 0
+        missing = np.where(photoID[rows] != photos)[0]
+        if len(missing):
+            raise KeyError(photos[missing[0]])
+        return rows
+
+    def _blob(self, field):
+        if field not in self._blobs:
+            path = os.path.join(self.path, field + '.txt')
+            with open(path, 'rb') as f:
+                self._blobs[field] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ) \
+                    if os.path.getsize(path) else ''
+        return self._blobs[field]
+
+    def text(self, field, row):
+        """Get text field (title, description or tags) of a given row"""
+        start, stop = self.column(field)[row]
+        return self._blob(field)[start:stop].decode('utf8')
+
+    def texts(self, field, rows):
+        """Iterate over text field (title, description or tags) of rows"""
+        blob = self._blob(field)
+        for start, stop in self.column(field)[rows].tolist():
+            yield blob[start:stop].decode('utf8')
+
+
+def do_ingest(metadata_json, metadata_dir):
+
+    if not os.path.isdir(metadata_dir):
+        os.makedirs(metadata_dir)
+
+    photoID = []
+    username = []
+    dateTaken = []
+    latitude = []
+    longitude = []
+
+    usernames = {}
+
+    blobs = {field: open(os.path.join(metadata_dir, field + '.txt'), 'wb')
+             for field in TEXT_FIELDS}
+    offsets = {field: [] for field in TEXT_FIELDS}
+    position = {field: 0 for field in TEXT_FIELDS}
+
+    with codecs.open(metadata_json, 'rt', encoding='utf8') as f:
+        for line in f:
+
+            obj = json.loads(line)
+
+            photoID.append(int(obj['photoID']))
+            username.append(
+                usernames.setdefault(obj['username'], len(usernames)))
+            dateTaken.append(parse_date(obj['dateTaken']))
+
+            if 'longitude' in obj:
+                latitude.append(float(obj['latitude']))
+                longitude.append(float(obj['longitude']))
+            else:
+                latitude.append(np.NaN)
+                longitude.append(np.NaN)
+
+            for field in TEXT_FIELDS:
+                text = obj.get(field) or u''
+                if isinstance(text, list):
+                    text = u' '.join(text)
+                text = text.encode('utf8')
+                blobs[field].write(text)
+                start = position[field]
+                position[field] = start + len(text)
+                offsets[field].append((start, position[field]))
+
+    for blob in blobs.values():
+        blob.close()
+
+    # sort rows by photoID for fast lookup
+    photoID = np.array(photoID, dtype=np.int64)
+    order = np.argsort(photoID, kind='mergesort')
+
+    latitude = np.array(latitude, dtype=np.float64)[order]
+    longitude = np.array(longitude, dtype=np.float64)[order]
+
+    columns = {
+        'photoID': photoID[order],
+        'username': np.array(username, dtype=np.int32)[order],
+        'dateTaken': np.array(dateTaken, dtype=np.int64)[order],
+        'latitude': latitude,
+        'longitude': longitude,
+        'geotagged': ~(np.isnan(latitude) | np.isnan(longitude)),
+    }
+    for field in TEXT_FIELDS:
+        columns[field] = np.array(offsets[field],
+                                  dtype=np.int64).reshape((-1, 2))[order]
+
+    for name, column in columns.iteritems():
+        np.save(os.path.join(metadata_dir, name + '.npy'), column)
+
+    path = os.path.join(metadata_dir, 'usernames.txt')
+    with codecs.open(path, 'w', encoding='utf8') as f:
+        for name, _ in sorted(usernames.iteritems(), key=lambda x: x[1]):
+            f.write(name + u'\n')
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    metadata_json = arguments['<metadata.json>']
+    metadata_dir = arguments['<metadata.dir>']
+    Cache().run(__file__, [metadata_json], {}, [metadata_dir],
+                do_ingest, metadata_json, metadata_dir)
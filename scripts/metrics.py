@@ -24,7 +24,140 @@
 # SOFTWARE.
 
 
-from sklearn.metrics import homogeneity_score, completeness_score
+"""Evaluate clustering results against a reference clustering
+
+All scores are derived from one sparse contingency table between reference
+and hypothesis labels:
+
+  NMI           normalized mutual information (geometric mean normalization)
+  F1            clustering F-measure: mean over reference clusters, weighted by
+                their size, of the F1 of their best matching hypothesis cluster
+  Div. F1       divergence from a random baseline: F1 minus the average F1 of
+                hypotheses with the same cluster sizes but shuffled images
+  homogeneity   see sklearn.metrics.homogeneity_score
+  completeness  see sklearn.metrics.completeness_score
+
+Only images found in both reference and hypothesis are evaluated.
+
+Usage:
+  metrics.py [--jobs=<jobs>] [--random=<n>] <reference.txt> <hypothesis.txt>...
+  metrics.py (-h | --help)
+  metrics.py --version
+
+Options:
+  --jobs=<jobs>  Number of hypotheses evaluated in parallel [default: 1].
+  --random=<n>   Number of random baselines for divergence F1 [default: 10].
+  -h --help      Show this screen.
+  --version      Show version.
+
+"""
+
+from docopt import docopt
+from clustering import CompactClustering
+from multiprocessing import Pool
+import scipy.sparse
+import numpy as np
+
+
+# random seed used for divergence F1
+SEED = 1234
+
+
+def contingency(reference_codes, hypothesis_codes):
+    """Sparse contingency table
+
+    Parameters
+    ----------
+    reference_codes, hypothesis_codes : numpy arrays
+        Reference and hypothesis labels of each image (any integers).
+
+    Returns
+    -------
+    table : scipy.sparse.csr_matrix
+        table[i, j] is the number of images in both i-th reference cluster
+        and j-th hypothesis cluster (in sorted label order).
+    """
+    _, r = np.unique(reference_codes, return_inverse=True)
+    _, h = np.unique(hypothesis_codes, return_inverse=True)
+    return _table(r, h)
+
+
+def _table(r, h):
+    # r and h are 0-based consecutive label codes
+    table = scipy.sparse.coo_matrix(
+        (np.ones((len(r), ), dtype=np.int64), (r, h)),
+        shape=(np.max(r) + 1 if len(r) else 0,
+               np.max(h) + 1 if len(h) else 0))
+    return table.tocsr()
+
+
+def _entropy(counts, N):
+    p = counts[counts > 0] / float(N)
+    return -np.sum(p * np.log(p))
+
+
+def scores(table):
+    """Homogeneity, completeness, NMI and F1 from contingency table"""
+
+    table = scipy.sparse.csr_matrix(table)
+    N = table.sum()
+    a = np.asarray(table.sum(axis=1)).reshape((-1, ))  # reference sizes
+    b = np.asarray(table.sum(axis=0)).reshape((-1, ))  # hypothesis sizes
+
+    n, j = table.data.astype(np.float64), table.indices
+    i = np.repeat(np.arange(len(a)), np.diff(table.indptr))
+
+    # entropies and mutual information
+    H_r, H_h = _entropy(a, N), _entropy(b, N)
+    MI = np.sum(n / N * (np.log(n * N) - np.log(1. * a[i] * b[j])))
+    MI = max(0., MI)
+
+    homogeneity = 1. if H_r == 0 else MI / H_r
+    completeness = 1. if H_h == 0 else MI / H_h
+    if H_r == 0 and H_h == 0:
+        nmi = 1.
+    elif H_r == 0 or H_h == 0:
+        nmi = 0.
+    else:
+        nmi = MI / np.sqrt(H_r * H_h)
+
+    # F1 of each (reference, hypothesis) pair with common images
+    f1 = 2. * n / (a[i] + b[j])
+    present = a > 0
+    best = np.zeros((len(a), ))
+    best[present] = np.maximum.reduceat(f1, table.indptr[:-1][present])
+    F1 = np.sum(a * best) / N
+
+    return {'homogeneity': homogeneity, 'completeness': completeness,
+            'nmi': nmi, 'f1': F1}
+
+
+def divergence_f1(reference_codes, hypothesis_codes, n_random=10, seed=SEED):
+    """F1 minus average F1 of randomly shuffled hypotheses"""
+    _, r = np.unique(reference_codes, return_inverse=True)
+    _, h = np.unique(hypothesis_codes, return_inverse=True)
+    f1 = scores(_table(r, h))['f1']
+    random = np.random.RandomState(seed)
+    baseline = [scores(_table(r, random.permutation(h)))['f1']
+                for _ in range(n_random)]
+    return f1 - np.mean(baseline)
+
+
+def evaluate(reference_codes, hypothesis_codes, n_random=10):
+    """All scores (including divergence F1)
+
+    Parameters
+    ----------
+    reference_codes, hypothesis_codes : numpy arrays
+        Reference and hypothesis labels of each image.
+    n_random : int, optional
+        Number of random baselines for divergence F1. Defaults to 10.
+    """
+    results = scores(contingency(reference_codes, hypothesis_codes))
+    results['divergence_f1'] = divergence_f1(reference_codes, hypothesis_codes,
+                                             n_random=n_random)
+    results['clusters'] = len(np.unique(hypothesis_codes))
+    return results
 
 
 def homogeneity(reference, hypothesis, images):
@@ -34,13 +167,72 @@ def homogeneity(reference, hypothesis, images):
     >>> images =  # list of images to evaluate
     >>> homogeneity(reference, hypothesis, images)
     """
-    return homogeneity_score(
-        reference.to_list(images),
-        hypothesis.to_list(images)
-    )
+    table = contingency(reference.to_list(images), hypothesis.to_list(images))
+    return scores(table)['homogeneity']
+
 
 def completeness(reference, hypothesis, images):
-    return completeness_score(
-        reference.to_list(images),
-        hypothesis.to_list(images)
-    )
+    table = contingency(reference.to_list(images), hypothesis.to_list(images))
+    return scores(table)['completeness']
+
+
+def align(reference, hypothesis):
+    """Labels of images found in both reference and hypothesis
+
+    Parameters
+    ----------
+    reference, hypothesis : CompactClustering
+
+    Returns
+    -------
+    reference_codes, hypothesis_codes : numpy arrays
+    """
+    ref_items, ref_labels = reference.to_arrays()
+    hyp_items, hyp_labels = hypothesis.to_arrays()
+
+    order = np.argsort(ref_items)
+    ref_items, ref_labels = ref_items[order], ref_labels[order]
+
+    position = np.searchsorted(ref_items, hyp_items)
+    position[position == len(ref_items)] = 0
+    found = ref_items[position] == hyp_items if len(ref_items) else \
+        np.zeros((len(hyp_items), ), dtype=bool)
+
+    return ref_labels[position[found]], hyp_labels[found]
+
+
+# shared with forked worker processes
+reference = None
+n_random = 10
+
+
+def _evaluate_file(hypothesis_txt):
+    hypothesis = CompactClustering.load(hypothesis_txt)
+    reference_codes, hypothesis_codes = align(reference, hypothesis)
+    results = evaluate(reference_codes, hypothesis_codes, n_random=n_random)
+    results['images'] = len(reference_codes)
+    return hypothesis_txt, results
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    reference = CompactClustering.load(arguments['<reference.txt>'])
+    n_random = int(arguments['--random'])
+    jobs = int(arguments['--jobs'])
+    hypotheses = arguments['<hypothesis.txt>']
+
+    if jobs > 1:
+        pool = Pool(min(jobs, len(hypotheses)))
+        results = pool.map(_evaluate_file, hypotheses)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_evaluate_file, hypotheses)
+
+    print "hypothesis\timages\tclusters\tNMI\tF1\tDiv. F1\thomogeneity\tcompleteness"
+    for hypothesis_txt, r in results:
+        print "%s\t%d\t%d\t%.4f\t%.4f\t%.4f\t%.4f\t%.4f" % (
+            hypothesis_txt, r['images'], r['clusters'], r['nmi'], r['f1'],
+            r['divergence_f1'], r['homogeneity'], r['completeness'])
@@ -0,0 +1,703 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License (MIT)
+
+# Copyright (c) 2014 Hervé BREDIN
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Incremental user + time pre-clustering of newly arriving photos
+
+The state of the pre-clustering (photos with their user, date and
+pre-cluster, L2-normalized features and cosine distance matrix between
+pre-cluster medoids) is kept in <state.dir>. Every `add` assigns a batch of
+new photos to existing or new pre-clusters:
+
+  * only timelines of users found in the batch are swept again (see
+    DataReduction.py), so that the result is the same as pre-clustering all
+    photos at once;
+  * pre-clusters whose photos did not change keep their label, labels of
+    vanished pre-clusters are reused so that labels remain 0 to K - 1;
+  * medoids (see cluster_distance.py) and rows of the distance matrix are
+    only recomputed for new or modified pre-clusters.
+
+The state is made of memory-mapped files that `add` appends to (photos and
+features) or updates in place (labels, medoids and distances), so that it is
+never loaded nor saved as a whole. Photos that were already added are found
+by binary search in a few sorted runs of photo IDs (merged like a binary
+counter, so that every ID is copied O(log N) times overall) and photos of a
+user are chained from their last one. Hence, the cost of `add` is
+proportional to the size of the batch (times log N for duplicate checks),
+to the number of photos of the users found in the batch, and to the number
+of modified pre-clusters times K.
+
+Updates are atomic: until `add` is followed by a successful `save`, the
+previous state is kept (photos and features appended by an interrupted
+`add` are dropped, and values it overwrote are restored, the next time the
+state is loaded).
+
+`export` saves the current pre-clustering and its K x K distance matrix (in
+sorted pre-cluster order, as produced by DataReduction.py and
+cluster_distance.py) for use by hac.py.
+
+Usage:
+  online.py add [--metadata=<dir>] [--alpha=<seconds>] [--dtype=<dtype>] <state.dir> <image.txt> <features.npy>
+  online.py export <state.dir> <pre_clustering.txt> <distance.npy>
+  online.py (-h | --help)
+  online.py --version
+
+Options:
+  --metadata=<dir>    Metadata directory (see metadata.py)
+                      [default: /vol/corpora4/mediaeval/2014/SED_2014_Dev_Metadata].
+  --alpha=<seconds>   Pre-clustering time threshold (only used when creating
+                      state). Defaults to 86400.
+  --dtype=<dtype>     Precision of features and distances (only used when
+                      creating state) [default: float64].
+  -h --help           Show this screen.
+  --version           Show version.
+
+"""
+
+from docopt import docopt
+from clustering import CompactClustering
+from cluster_distance import l2_normalize, medoids
+from metadata import Metadata
+from pairwise import tile_distance
+from DataReduction import sweepTimeline
+import simplejson as json
+import numpy as np
+import os
+
+
+# initial capacity (number of pre-clusters) of distance matrix
+# (and number of users of the last photo index)
+CAPACITY = 1024
+
+# record of a photo, in the order photos were added
+# (previous is the row of the previous photo of the same user, or -1)
+PHOTO = np.dtype([('photo', np.int64), ('user', np.int64),
+                  ('date', np.float64), ('label', np.int64),
+                  ('previous', np.int64)])
+
+# files of a state (in addition to sorted runs of photo IDs)
+FILES = ['photos.bin', 'features.bin', 'last.npy', 'medoid.npy',
+         'distance.npy', 'journal.npz']
+
+# empty journal of labels (or last photos)
+_EMPTY = (np.empty((0, ), dtype=np.int64), np.empty((0, ), dtype=np.int64))
+
+
+def _first(journal, indices, values):
+    """Add original values to journal (values already found in journal are
+    older, hence kept)"""
+    indices = np.hstack([journal[0], indices])
+    values = np.hstack([journal[1], values])
+    # stable, so that the first occurrence of every index is returned
+    indices, first = np.unique(indices, return_index=True)
+    return indices, values[first].astype(np.int64)
+
+
+class OnlinePreClustering(object):
+    """Incremental user + time pre-clustering
+
+    Parameters
+    ----------
+    path : str
+        State directory.
+    alpha : int, optional
+        Pre-clustering time threshold, in seconds. Only used when creating a
+        new state. Defaults to 86400.
+    dtype : numpy dtype, optional
+        Precision of features and distances. Only used when creating a new
+        state. Defaults to float64.
+
+    >>> online = OnlinePreClustering('/path/to/state')
+    >>> online.add(photos, users, dates, features)
+    >>> online.save()
+    >>> pre_clustering = online.clustering()
+    >>> distance = online.distance()
+    """
+
+    def __init__(self, path, alpha=None, dtype=np.float64):
+        super(OnlinePreClustering, self).__init__()
+
+        self.path = path
+
+        if os.path.exists(self._path('state.json')):
+            with open(self._path('state.json'), 'r') as f:
+                state = json.load(f)
+            self.alpha = state['alpha']
+            self.dtype = np.dtype(state['dtype'])
+            self.dimension = state['dimension']
+            self.n_clusters = state['n_clusters']
+            self._n_photos = state['n_photos']
+            self._index = [tuple(run) for run in state['index']]
+            self._generation = state['generation']
+
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            # leftovers of a state that was never saved
+            for name in os.listdir(path):
+                if name in FILES or name.startswith('index.'):
+                    os.remove(self._path(name))
+            self.alpha = 86400 if alpha is None else int(alpha)
+            self.dtype = np.dtype(dtype)
+            self.dimension = None
+            self.n_clusters = 0
+            self._n_photos = 0
+            self._index = []
+            self._generation = 0
+
+        self._map()
+        if self._generation:
+            self._recover()
+
+        # original values overwritten since last save
+        self._journal = {'distance': {}, 'label': _EMPTY, 'last': _EMPTY}
+        self._saved_clusters = self.n_clusters
+        self._saved_photos = len(self)
+
+    def _path(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self, name):
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r+')
+
+    def _map(self):
+        """Memory-map state"""
+        self._map_photos()
+        self._last = self._load('last.npy')
+        self.medoid = self._load('medoid.npy')
+        self._distance = self._load('distance.npy')
+
+    def _map_photos(self):
+        if self._n_photos:
+            self._photos = np.memmap(self._path('photos.bin'), dtype=PHOTO,
+                                     mode='r+', shape=(self._n_photos, ))
+        else:
+            self._photos = np.empty((0, ), dtype=PHOTO)
+        self.photo = self._photos['photo']
+        self.user = self._photos['user']
+        self.date = self._photos['date']
+        self.label = self._photos['label']
+        self.previous = self._photos['previous']
+
+    def _run(self, start, stop):
+        """Path to sorted IDs of photos added at rows start to stop - 1"""
+        name = 'index.{start:d}-{stop:d}.npy'.format(start=start, stop=stop)
+        return self._path(name)
+
+    def _recover(self):
+        """Undo changes of an `add` that was not followed by `save`"""
+
+        # restore values it overwrote
+        journal = self._path('journal.npz')
+        if os.path.exists(journal):
+            with np.load(journal) as data:
+                if int(data['generation']) == self._generation:
+                    self._restore(data)
+            os.remove(journal)
+
+        # drop photos and features it appended
+        for name, size in [
+                ('photos.bin', len(self) * PHOTO.itemsize),
+                ('features.bin',
+                 len(self) * (self.dimension or 0) * self.dtype.itemsize)]:
+            path = self._path(name)
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+        # and sorted runs of photo IDs it created
+        runs = set(os.path.basename(self._run(*run)) for run in self._index)
+        for name in os.listdir(self.path):
+            if name.startswith('index.') and name not in runs:
+                os.remove(self._path(name))
+
+    def _restore(self, data):
+        """Restore values saved in journal"""
+
+        clusters = data['clusters']
+        if len(clusters):
+            K = data['row'].shape[1]
+            self._distance[clusters, :K] = data['row']
+            self._distance[:K, clusters] = data['column'].T
+            self.medoid[clusters] = data['medoid']
+        if len(data['rows']):
+            self.label[data['rows']] = data['label']
+        if len(data['users']):
+            self._last[data['users']] = data['last']
+        self._flush()
+
+    def _backup(self, clusters=(), rows=(), users=()):
+        """Save original values of saved state before overwriting them
+
+        Parameters
+        ----------
+        clusters : iterable, optional
+            Pre-clusters whose medoid and rows (and columns) of distance
+            matrix are about to be overwritten.
+        rows : iterable, optional
+            Photos whose label is about to be overwritten.
+        users : iterable, optional
+            Users whose last photo is about to be overwritten.
+        """
+
+        journal = self._journal
+
+        K = self._saved_clusters
+        clusters = [k for k in set(clusters)
+                    if k < K and k not in journal['distance']]
+        for k in clusters:
+            # distance matrix is only symmetric up to rounding errors
+            journal['distance'][k] = (np.array(self._distance[k, :K]),
+                                      np.array(self._distance[:K, k]),
+                                      self.medoid[k])
+
+        rows = np.asarray(rows, dtype=np.int64)
+        rows = rows[rows < self._saved_photos]
+        n_rows = len(journal['label'][0])
+        journal['label'] = _first(journal['label'], rows, self.label[rows])
+
+        # users that did not exist yet are saved as well (as -1) since the
+        # array of last photos is grown before being backed up
+        users = np.asarray(users, dtype=np.int64)
+        n_users = len(journal['last'][0])
+        if len(users):
+            journal['last'] = _first(journal['last'], users,
+                                     self._last[users])
+
+        if not clusters and len(journal['label'][0]) == n_rows and \
+           len(journal['last'][0]) == n_users:
+            return
+
+        clusters = sorted(journal['distance'])
+        path = self._path('journal.npz')
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            np.savez(
+                f, generation=self._generation,
+                clusters=np.array(clusters, dtype=np.int64),
+                row=np.array([journal['distance'][k][0] for k in clusters],
+                             dtype=self.dtype).reshape((len(clusters), K)),
+                column=np.array([journal['distance'][k][1] for k in clusters],
+                                dtype=self.dtype).reshape((len(clusters), K)),
+                medoid=np.array([journal['distance'][k][2] for k in clusters],
+                                dtype=np.int64),
+                rows=journal['label'][0], label=journal['label'][1],
+                users=journal['last'][0], last=journal['last'][1])
+        os.rename(temporary, path)
+
+    def _flush(self):
+        for array in [self._photos, self._last, self.medoid, self._distance]:
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def __len__(self):
+        return len(self._photos)
+
+    def _features(self):
+        """(Memory-mapped) L2-normalized features of all photos"""
+        if not len(self):
+            return np.empty((0, self.dimension or 0), dtype=self.dtype)
+        return np.memmap(self._path('features.bin'), dtype=self.dtype,
+                         mode='r', shape=(len(self), self.dimension))
+
+    def _grow(self, name, shape, dtype, size, fill=None):
+        """Replace memory-mapped array by a larger one
+
+        Parameters
+        ----------
+        name : str
+            File name of array (which may not exist yet).
+        shape : tuple
+            Shape of larger array.
+        dtype : numpy dtype
+        size : int
+            Only the first `size` entries (along every axis) are copied.
+        fill : optional
+            Value of other entries. Defaults to zero.
+        """
+
+        path = self._path(name)
+        temporary = path + '.tmp'
+        grown = np.lib.format.open_memmap(temporary, mode='w+',
+                                          dtype=dtype, shape=shape)
+        if fill is not None:
+            grown[:] = fill
+        if size:
+            array = np.load(path, mmap_mode='r')
+            for start in range(0, size, CAPACITY):
+                stop = min(size, start + CAPACITY)
+                block = (slice(start, stop), ) + \
+                    (slice(None, size), ) * (len(shape) - 1)
+                grown[block] = array[block]
+            del array
+        grown.flush()
+        del grown
+        os.rename(temporary, path)
+        return np.load(path, mmap_mode='r+')
+
+    def _reserve(self, n_clusters):
+        """Make room for n_clusters in distance matrix (and medoids)"""
+
+        capacity = 0 if self._distance is None else len(self._distance)
+        if n_clusters <= capacity:
+            return
+
+        # double capacity so that growing is amortized
+        capacity = max(CAPACITY, 2 * capacity, n_clusters)
+        K = self.n_clusters
+        # medoids first, so that there are always enough of them
+        self.medoid = self._grow('medoid.npy', (capacity, ), np.int64, K,
+                                 fill=-1)
+        self._distance = self._grow('distance.npy', (capacity, capacity),
+                                    self.dtype, K)
+
+    def _reserve_users(self, n_users):
+        """Make room for n_users in last photo index"""
+
+        capacity = 0 if self._last is None else len(self._last)
+        if n_users <= capacity:
+            return
+
+        # double capacity so that growing is amortized
+        size = capacity
+        capacity = max(CAPACITY, 2 * capacity, n_users)
+        self._last = self._grow('last.npy', (capacity, ), np.int64, size,
+                                fill=-1)
+
+    def _contains(self, photos):
+        """Whether photos were already added"""
+        found = np.zeros((len(photos), ), dtype=bool)
+        for start, stop in self._index:
+            run = np.load(self._run(start, stop), mmap_mode='r')
+            position = np.minimum(np.searchsorted(run, photos), len(run) - 1)
+            found |= run[position] == photos
+        return found
+
+    def _insert(self, photos):
+        """Add sorted run of IDs of photos that were just appended
+
+        Last runs are merged as long as they are not larger than the new
+        one, so that there are at most O(log N) runs.
+        """
+
+        stop = len(self)
+        start = stop - len(photos)
+        run = np.sort(photos)
+        while self._index and \
+                self._index[-1][1] - self._index[-1][0] <= stop - start:
+            start, end = self._index.pop()
+            run = np.sort(np.hstack([np.load(self._run(start, end)), run]),
+                          kind='mergesort')
+        np.save(self._run(start, stop), run)
+        self._index.append((start, stop))
+
+    def _timelines(self, users):
+        """Rows of photos of users
+
+        Rows are sorted by user, then by date (and then in the order photos
+        were added), by following every user's chain of photos.
+        """
+
+        rows = []
+        row = self._last[users]
+        row = row[row >= 0]
+        while len(row):
+            rows.append(row)
+            row = self.previous[row]
+            row = row[row >= 0]
+        if not rows:
+            return np.empty((0, ), dtype=np.int64)
+        rows = np.hstack(rows)
+        return rows[np.lexsort((rows, self.date[rows], self.user[rows]))]
+
+    def _members(self, k):
+        """Rows of photos of existing pre-cluster k"""
+        rows = self._timelines([self.user[self.medoid[k]]])
+        return rows[self.label[rows] == k]
+
+    def _move(self, source, target, rows):
+        """Relabel pre-cluster `source` (made of `rows`) as (vanished)
+        pre-cluster `target`"""
+        K = self.n_clusters
+        self.label[rows] = target
+        self.medoid[target] = self.medoid[source]
+        self._distance[target, :K] = self._distance[source, :K]
+        self._distance[:K, target] = self._distance[:K, source]
+        self._distance[target, target] = self._distance[source, source]
+
+    def add(self, photos, users, dates, features):
+        """Add a batch of photos
+
+        Photos that were already added are ignored.
+
+        Parameters
+        ----------
+        photos, users, dates : (n, ) numpy arrays
+            Photo IDs, user codes (metadata.username) and dates taken
+            (metadata.dateTaken). User codes are used as indices (of the
+            last photo of every user), hence should be small non-negative
+            integers.
+        features : (n, d) numpy array
+            Features of photos (e.g. color histograms).
+
+        Returns
+        -------
+        modified : numpy array
+            Labels of new or modified pre-clusters.
+        """
+
+        # first occurrence of photos that were not already added
+        photos = np.asarray(photos, dtype=np.int64)
+        _, unique = np.unique(photos, return_index=True)
+        new = np.zeros((len(photos), ), dtype=bool)
+        new[unique] = ~self._contains(photos[unique])
+        rows = np.where(new)[0]
+        if not len(rows):
+            return np.empty((0, ), dtype=np.int64)
+        photos = photos[rows]
+        users = np.asarray(users, dtype=np.int64)[rows]
+        dates = np.asarray(dates, dtype=np.float64)[rows]
+
+        # append L2-normalized features
+        normalized = l2_normalize(features, rows=rows, dtype=self.dtype)
+        if self.dimension is None:
+            self.dimension = normalized.shape[1]
+        with open(self._path('features.bin'), 'ab') as f:
+            normalized.tofile(f)
+
+        # chain photos of every user (in the order they were added)
+        self._reserve_users(np.max(users) + 1)
+        start = len(self)
+        rows = start + np.arange(len(photos))
+        order = np.argsort(users, kind='mergesort')
+        chained = users[order]
+        first = np.hstack([[True], chained[1:] != chained[:-1]])
+        latest = np.hstack([first[1:], [True]])
+        previous = np.empty((len(photos), ), dtype=np.int64)
+        previous[order] = np.where(first, self._last[chained],
+                                   np.hstack([[-1], rows[order][:-1]]))
+
+        # append photos
+        record = np.empty((len(photos), ), dtype=PHOTO)
+        record['photo'] = photos
+        record['user'] = users
+        record['date'] = dates
+        record['label'] = -1
+        record['previous'] = previous
+        with open(self._path('photos.bin'), 'ab') as f:
+            record.tofile(f)
+        self._n_photos = start + len(photos)
+        self._map_photos()
+        self._insert(photos)
+
+        self._backup(users=chained[latest])
+        self._last[chained[latest]] = rows[order][latest]
+
+        # chronological timeline of every user found in the batch
+        affected = self._timelines(chained[latest])
+        boundaries = np.where(np.diff(self.user[affected]))[0] + 1
+        timelines = [(timeline, self.date[timeline].tolist())
+                     for timeline in np.split(affected, boundaries)]
+
+        # sweep them again (one user at a time, so that pre-clusters never
+        # span several users)
+        segments = []
+        for timeline, dates in timelines:
+            assignment, _ = sweepTimeline(timeline.tolist(), dates, self.alpha)
+            clusters = {}
+            for row, k in assignment.iteritems():
+                clusters.setdefault(k, []).append(row)
+            segments.extend(np.array(rows, dtype=np.int64)
+                            for rows in clusters.values())
+
+        # pre-clusters that did not change keep their label
+        labels = self.label[affected]
+        vanished = set(labels[labels >= 0].tolist())
+        sizes = dict(zip(*np.unique(labels, return_counts=True)))
+        modified = []
+        for segment in segments:
+            labels = np.unique(self.label[segment])
+            if len(labels) == 1 and labels[0] >= 0 and \
+               sizes[labels[0]] == len(segment):
+                vanished.discard(labels[0])
+            else:
+                modified.append(segment)
+
+        # reuse labels of vanished pre-clusters first
+        free = sorted(vanished)
+        K = self.n_clusters
+        n_clusters = K + max(0, len(modified) - len(free))
+        self._reserve(n_clusters)
+        targets = (free + range(K, n_clusters))[:len(modified)]
+
+        # keep labels contiguous by moving last pre-clusters to
+        # remaining vanished labels
+        remaining = set(free[len(modified):])
+        moves = []
+        while remaining:
+            last = n_clusters - 1
+            if last not in remaining:
+                target = min(remaining)
+                if last in targets:
+                    targets[targets.index(last)] = target
+                else:
+                    moves.append((last, target, self._members(last)))
+                remaining.discard(target)
+            else:
+                remaining.discard(last)
+            n_clusters -= 1
+
+        # only labels of photos of modified (or moved) pre-clusters and
+        # rows (and columns) of vanished pre-clusters are overwritten
+        self._backup(clusters=free,
+                     rows=np.hstack([_EMPTY[0]] + modified +
+                                    [rows for _, _, rows in moves]))
+        for segment, target in zip(modified, targets):
+            self.label[segment] = target
+        for source, target, rows in moves:
+            self._move(source, target, rows)
+        self.n_clusters = n_clusters
+
+        # medoids of modified pre-clusters
+        if modified:
+            members = np.hstack([np.sort(segment) for segment in modified])
+            codes = np.repeat(np.arange(len(modified)),
+                              [len(segment) for segment in modified])
+            features = self._features()
+            positions = medoids(np.array(features[members]), codes,
+                                n_clusters=len(modified))
+            targets = np.array(targets, dtype=np.int64)
+            self.medoid[targets] = members[positions]
+
+            # their rows (and columns) of the distance matrix
+            K = self.n_clusters
+            centroids = np.array(features[self.medoid[:K]])
+            distance = tile_distance(centroids[targets], centroids,
+                                     metric='cosine', dtype=self.dtype)
+            self._distance[targets, :K] = distance
+            self._distance[:K, targets] = distance.T
+
+        return np.array(sorted(targets), dtype=np.int64) if modified else \
+            np.empty((0, ), dtype=np.int64)
+
+    def save(self):
+        """Save state
+
+        Renaming state.json is the only step that commits the new state, so
+        that the previous one is kept if this is interrupted.
+        """
+
+        self._flush()
+
+        generation = self._generation + 1
+        path = self._path('state.json')
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'alpha': self.alpha, 'dtype': self.dtype.name,
+                       'dimension': self.dimension,
+                       'n_clusters': self.n_clusters,
+                       'n_photos': len(self), 'index': self._index,
+                       'generation': generation}, f)
+        os.rename(temporary, path)
+
+        # previous state is no longer needed
+        self._generation = generation
+        runs = set(os.path.basename(self._run(*run)) for run in self._index)
+        for name in os.listdir(self.path):
+            if name.startswith('index.') and name not in runs:
+                os.remove(self._path(name))
+        if os.path.exists(self._path('journal.npz')):
+            os.remove(self._path('journal.npz'))
+        self._journal = {'distance': {}, 'label': _EMPTY, 'last': _EMPTY}
+        self._saved_clusters = self.n_clusters
+        self._saved_photos = len(self)
+
+    def clustering(self):
+        """Current pre-clustering (labels 0 to K - 1)"""
+        return CompactClustering.from_arrays(self.photo, self.label)
+
+    def distance(self):
+        """Current K x K distance matrix between pre-cluster medoids"""
+        K = self.n_clusters
+        if self._distance is None:
+            return np.empty((0, 0), dtype=self.dtype)
+        return self._distance[:K, :K]
+
+
+def do_add(state_dir, image_txt, features_npy, metadata_dir,
+           alpha=None, dtype=np.float64):
+
+    online = OnlinePreClustering(state_dir, alpha=alpha, dtype=dtype)
+    if alpha is not None and online.alpha != alpha:
+        print 'WARNING: using alpha = {alpha} from existing state'.format(
+            alpha=online.alpha)
+
+    # load image list and its metadata
+    with open(image_txt, 'r') as f:
+        images = [int(line.strip()) for line in f.readlines()]
+    metadata = Metadata(metadata_dir)
+    rows = metadata.index(images)
+
+    # memory-map features (only new photos are read)
+    features = np.load(features_npy, mmap_mode='r')
+
+    n_photos = len(online)
+    modified = online.add(images, metadata.username[rows],
+                          metadata.dateTaken[rows], features)
+    online.save()
+
+    print '{n} new photos, {m} new or modified pre-clusters ({K} total)'.format(
+        n=len(online) - n_photos, m=len(modified), K=online.n_clusters)
+
+
+def do_export(state_dir, pre_clustering_txt, distance_npy):
+
+    online = OnlinePreClustering(state_dir)
+    online.clustering().save(pre_clustering_txt)
+    np.save(distance_npy, online.distance())
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    state_dir = arguments['<state.dir>']
+
+    if arguments['add']:
+        image_txt = arguments['<image.txt>']
+        features_npy = arguments['<features.npy>']
+        metadata_dir = arguments['--metadata']
+        alpha = arguments['--alpha']
+        alpha = None if alpha is None else int(alpha)
+        dtype = np.dtype(arguments['--dtype'])
+        do_add(state_dir, image_txt, features_npy, metadata_dir,
+               alpha=alpha, dtype=dtype)
+
+    if arguments['export']:
+        pre_clustering_txt = arguments['<pre_clustering.txt>']
+        distance_npy = arguments['<distance.npy>']
+        do_export(state_dir, pre_clustering_txt, distance_npy)
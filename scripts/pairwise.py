@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License (MIT)
+
+# Copyright (c) 2014 Hervé BREDIN
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Generate pairwise histogram distance matrix
+
+Distances between all rows of <features.npy> (e.g. color histograms, as
+produced by color_histogram.py) are computed one tile at a time, in float32
+(histograms are assumed to be L1-normalized):
+
+  intersection   1 - sum(min(x, y))
+  chi2           1/2 sum((x - y)^2 / (x + y))
+  bhattacharyya  sqrt(1 - sum(sqrt(x * y)))
+  cosine         1 - sum(x * y)  (rows are assumed to be L2-normalized)
+
+Tiles are spread over a pool of threads (NumPy releases the GIL).
+
+The output is either a dense N x N distance matrix (.npy) or -- with --top --
+a sparse matrix (.npz) only containing the distances to the k nearest rows of
+each row. Rows containing NaN (e.g. images that could not be processed) are
+at NaN (dense) or missing (sparse) distance of every other row.
+
+Usage:
+  pairwise.py [--metric=<metric>] [--top=<k>] [--jobs=<jobs>] [--tile=<tile>] [--dtype=<dtype>] <features.npy> <output>
+  pairwise.py (-h | --help)
+  pairwise.py --version
+
+Options:
+  --metric=<metric>  intersection, chi2, bhattacharyya or cosine [default: intersection].
+  --top=<k>          Only keep the k nearest neighbours of each row.
+  --jobs=<jobs>      Number of threads [default: 1].
+  --tile=<tile>      Number of rows per tile [default: 1024].
+  --dtype=<dtype>    Precision of computation and output [default: float32].
+  -h --help          Show this screen.
+  --version          Show version.
+
+"""
+
+from docopt import docopt
+from cache import Cache
+from candidates import upper_pairs
+from matrix import save_matrix
+from multiprocessing.pool import ThreadPool
+from scipy.spatial.distance import cdist
+import scipy.sparse
+import numpy as np
+
+
+TILE = 1024
+
+# number of pairs processed at once when computing distances between given
+# pairs only (at most TILE ** 2 feature values are gathered at once)
+PAIR_BLOCK = 65536
+
+METRICS = ['intersection', 'chi2', 'bhattacharyya', 'cosine']
+
+
+def _intersection(X, Y):
+    # min(x, y) = (x + y - |x - y|) / 2, hence the (C) L1 distance
+    l1 = cdist(X, Y, 'cityblock')
+    similarity = .5 * (np.sum(X, axis=1)[:, np.newaxis] +
+                       np.sum(Y, axis=1) - l1)
+    return np.maximum(0., 1. - similarity).astype(X.dtype)
+
+
+def _chi2(X, Y):
+    # accumulate one dimension at a time to avoid (n, m, d) temporaries
+    distance = np.zeros((len(X), len(Y)), dtype=X.dtype)
+    difference = np.empty_like(distance)
+    total = np.empty_like(distance)
+    Xt, Yt = np.ascontiguousarray(X.T), np.ascontiguousarray(Y.T)
+    for x, y in zip(Xt, Yt):
+        # bins empty in both tiles do not contribute
+        if not (x.any() or y.any()):
+            continue
+        np.subtract.outer(x, y, out=difference)
+        np.add.outer(x, y, out=total)
+        difference *= difference
+        np.divide(difference, total, out=difference, where=total > 0)
+        distance += np.where(total > 0, difference, 0.)
+    distance *= .5
+    return distance
+
+
+def _bhattacharyya(X, Y):
+    coefficient = np.dot(np.sqrt(X), np.sqrt(Y).T)
+    return np.sqrt(np.maximum(0., 1. - coefficient), dtype=X.dtype)
+
+
+def _cosine(X, Y):
+    return 1. - np.dot(X, Y.T)
+
+
+DISTANCES = {
+    'intersection': _intersection,
+    'chi2': _chi2,
+    'bhattacharyya': _bhattacharyya,
+    'cosine': _cosine,
+}
+
+
+# same distances between x[k] and y[k] only
+
+def _paired_intersection(x, y):
+    return np.maximum(0., 1. - np.sum(np.minimum(x, y), axis=1))
+
+
+def _paired_chi2(x, y):
+    total = x + y
+    difference = (x - y) ** 2
+    np.divide(difference, total, out=difference, where=total > 0)
+    return .5 * np.sum(np.where(total > 0, difference, 0.), axis=1)
+
+
+def _paired_bhattacharyya(x, y):
+    coefficient = np.sum(np.sqrt(x * y), axis=1)
+    return np.sqrt(np.maximum(0., 1. - coefficient))
+
+
+def _paired_cosine(x, y):
+    return 1. - np.sum(x * y, axis=1)
+
+
+PAIRED_DISTANCES = {
+    'intersection': _paired_intersection,
+    'chi2': _paired_chi2,
+    'bhattacharyya': _paired_bhattacharyya,
+    'cosine': _paired_cosine,
+}
+
+
+def tile_distance(X, Y, metric='intersection', dtype=np.float32):
+    """Distance between all rows of X and all rows of Y
+
+    Parameters
+    ----------
+    X : (n, d) numpy array
+    Y : (m, d) numpy array
+    metric : {'intersection', 'chi2', 'bhattacharyya', 'cosine'}, optional
+    dtype : numpy dtype, optional
+        Precision of computation. Defaults to float32.
+
+    Returns
+    -------
+    distance : (n, m) numpy array
+    """
+    X = np.asarray(X, dtype=dtype)
+    Y = np.asarray(Y, dtype=dtype)
+    with np.errstate(invalid='ignore'):
+        distance = DISTANCES[metric](X, Y)
+        distance[np.any(np.isnan(X), axis=1)] = np.NaN
+        distance[:, np.any(np.isnan(Y), axis=1)] = np.NaN
+    return distance
+
+
+def _map(function, tasks, jobs):
+    if jobs > 1:
+        pool = ThreadPool(processes=jobs)
+        results = pool.map(function, tasks)
+        pool.close()
+        pool.join()
+        return results
+    return map(function, tasks)
+
+
+def pairwise_distance(X, metric='intersection', tile=TILE, jobs=1, out=None,
+                      dtype=np.float32):
+    """Dense distance matrix between all rows of X
+
+    Parameters
+    ----------
+    X : (N, d) numpy array
+    metric : {'intersection', 'chi2', 'bhattacharyya', 'cosine'}, optional
+    tile : int, optional
+        Number of rows per tile.
+    jobs : int, optional
+        Number of threads.
+    out : (N, N) numpy array, optional
+        Where to write distances (e.g. a memory-mapped array).
+    dtype : numpy dtype, optional
+        Precision of computation (and of output, unless `out` is provided).
+        Defaults to float32.
+
+    Returns
+    -------
+    distance : (N, N) numpy array
+    """
+
+    # rows are converted one tile at a time (X may be memory-mapped)
+    N = len(X)
+    if out is None:
+        out = np.empty((N, N), dtype=dtype)
+
+    # upper triangle tiles only, mirrored into lower triangle
+    tasks = [(i, j) for i in range(0, N, tile) for j in range(i, N, tile)]
+
+    def compute(task):
+        i, j = task
+        distance = tile_distance(X[i:i + tile], X[j:j + tile],
+                                 metric=metric, dtype=dtype)
+        out[i:i + tile, j:j + tile] = distance
+        if i != j:
+            out[j:j + tile, i:i + tile] = distance.T
+
+    _map(compute, tasks, jobs)
+    return out
+
+
+def top_k(X, k, metric='intersection', tile=TILE, jobs=1, dtype=np.float32):
+    """Sparse distance matrix between each row of X and its k nearest rows
+
+    The returned (N, N) matrix is symmetric: it contains (i, j) as soon as
+    j is among the k nearest rows of i or the other way around. A row is not
+    its own neighbour and rows containing NaN have no neighbours.
+    """
+
+    N = len(X)
+    k = min(k, N - 1)
+
+    def compute(i):
+        n = len(X[i:i + tile])
+
+        # running k nearest neighbours of rows i to i + n
+        best_cols = np.empty((n, 0), dtype=np.int64)
+        best_dist = np.empty((n, 0), dtype=dtype)
+
+        for j in range(0, N, tile):
+            distance = tile_distance(X[i:i + tile], X[j:j + tile],
+                                     metric=metric, dtype=dtype)
+            m = distance.shape[1]
+            cols = np.tile(np.arange(j, j + m), (n, 1))
+            distance[np.isnan(distance)] = np.inf
+            distance[cols == np.arange(i, i + n)[:, np.newaxis]] = np.inf
+
+            best_cols = np.hstack([best_cols, cols])
+            best_dist = np.hstack([best_dist, distance])
+            if best_dist.shape[1] > k:
+                keep = np.argpartition(best_dist, k - 1, axis=1)[:, :k]
+                best_cols = np.take_along_axis(best_cols, keep, axis=1)
+                best_dist = np.take_along_axis(best_dist, keep, axis=1)
+
+        rows = np.repeat(np.arange(i, i + n), best_cols.shape[1])
+        return rows, best_cols.reshape((-1, )), best_dist.reshape((-1, ))
+
+    results = _map(compute, range(0, N if k > 0 else 0, tile), jobs)
+    if not results:
+        return scipy.sparse.csr_matrix((N, N), dtype=dtype)
+
+    rows, cols, data = [np.hstack(r) for r in zip(*results)]
+    keep = np.isfinite(data)
+    rows, cols, data = rows[keep], cols[keep], data[keep]
+
+    # symmetrize: (i, j) and (j, i) only once each
+    rows, cols = np.hstack([rows, cols]), np.hstack([cols, rows])
+    data = np.hstack([data, data])
+    order = np.lexsort((cols, rows))
+    rows, cols, data = rows[order], cols[order], data[order]
+    first = np.ones((len(rows), ), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+
+    # explicit construction so that zero distances are kept
+    return scipy.sparse.coo_matrix(
+        (data[first], (rows[first], cols[first])), shape=(N, N)).tocsr()
+
+
+def pair_distance(X, pairs, metric='intersection', block=PAIR_BLOCK,
+                  dtype=np.float32):
+    """Sparse distance matrix between given pairs of rows of X only
+
+    Parameters
+    ----------
+    X : (N, d) numpy array
+    pairs : (N, N) scipy sparse matrix
+        Symmetric matrix whose stored entries are the pairs to compare
+        (e.g. candidate pairs from candidates.py).
+    metric : {'intersection', 'chi2', 'bhattacharyya', 'cosine'}, optional
+    block : int, optional
+        Maximum number of pairs processed at once. It is reduced for
+        high-dimensional features so that at most TILE ** 2 feature values
+        are gathered at once.
+    dtype : numpy dtype, optional
+        Precision of computation and output. Defaults to float32.
+
+    Returns
+    -------
+    distance : (N, N) scipy.sparse.csr_matrix
+        Pairs involving rows containing NaN are missing.
+    """
+
+    N = len(X)
+    rows, cols = upper_pairs(pairs)
+    block = max(1, min(block, TILE ** 2 // max(1, X.shape[1])))
+
+    distance = np.empty((len(rows), ), dtype=dtype)
+    for start in range(0, len(rows), block):
+        x = np.asarray(X[rows[start:start + block]], dtype=dtype)
+        y = np.asarray(X[cols[start:start + block]], dtype=dtype)
+        with np.errstate(invalid='ignore'):
+            d = PAIRED_DISTANCES[metric](x, y)
+            d[np.any(np.isnan(x), axis=1) | np.any(np.isnan(y), axis=1)] = \
+                np.NaN
+        distance[start:start + block] = d
+
+    keep = np.isfinite(distance)
+    rows, cols, distance = rows[keep], cols[keep], distance[keep]
+
+    # explicit construction so that zero distances are kept
+    return scipy.sparse.coo_matrix(
+        (np.hstack([distance, distance]),
+         (np.hstack([rows, cols]), np.hstack([cols, rows]))),
+        shape=(N, N)).tocsr()
+
+
+def do_it(features_npy, output, metric='intersection', top=None,
+          jobs=1, tile=TILE, dtype=np.float32):
+
+    # memory-map features (read-only, hence shareable between jobs)
+    features = np.load(features_npy, mmap_mode='r')
+
+    if top is None:
+        distance = pairwise_distance(features, metric=metric,
+                                     tile=tile, jobs=jobs, dtype=dtype)
+    else:
+        distance = top_k(features, top, metric=metric,
+                         tile=tile, jobs=jobs, dtype=dtype)
+
+    save_matrix(output, distance)
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    features_npy = arguments['<features.npy>']
+    output = arguments['<output>']
+    metric = arguments['--metric']
+    if metric not in METRICS:
+        raise ValueError('unknown metric "%s"' % metric)
+    top = arguments['--top']
+    top = None if top is None else int(top)
+    jobs = int(arguments['--jobs'])
+    tile = int(arguments['--tile'])
+    dtype = np.dtype(arguments['--dtype'])
+
+    # number of threads and tile size do not change the output
+    Cache().run(__file__, [features_npy],
+                {'metric': metric, 'top': top, 'dtype': str(dtype)}, [output],
+                do_it, features_npy, output, metric=metric, top=top,
+                jobs=jobs, tile=tile, dtype=dtype)
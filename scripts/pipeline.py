@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License (MIT)
+
+# Copyright (c) 2014 Hervé BREDIN
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Run the whole clustering pipeline in a single process
+
+Stages are chained in memory (no intermediate file is written or parsed):
+
+  pre-clustering    user + time pre-clustering (DataReduction.py)
+  distance          cosine distance between pre-cluster medoids
+                    (cluster_distance.py)
+  groundtruth       groundtruth between pre-clusters (groundtruth.py)
+  calibration       distance to probability (distance2probability.py)
+  hac               single-linkage clustering at <theta> (hac.py)
+
+groundtruth and calibration stages only run when --reference is provided:
+distances are then converted into the probability that two pre-clusters
+belong to the same event, and pre-clusters are merged as long as this
+probability is greater than or equal to 1 - <theta>. The final clustering is
+also evaluated against the reference.
+
+Only <output.txt> is saved, unless --checkpoint is provided, in which case
+the output of every stage is saved in this directory as well.
+
+Wall time and peak memory (resident set size) of every stage are reported.
+
+Usage:
+  pipeline.py [options] <image.txt> <features.npy> <theta> <output.txt>
+  pipeline.py (-h | --help)
+  pipeline.py --version
+
+Options:
+  --metadata=<dir>        Metadata directory (see metadata.py)
+                          [default: /vol/corpora4/mediaeval/2014/SED_2014_Dev_Metadata].
+  --alpha=<seconds>       Pre-clustering time threshold [default: 86400].
+  --top=<k>               Only keep the k nearest pre-clusters of each
+                          pre-cluster.
+  --dtype=<dtype>         Precision of distance computation [default: float64].
+  --reference=<ref.txt>   Calibrate distances on (and evaluate against) this
+                          reference clustering.
+  --bins=<bins>           Number of calibration histogram bins [default: 100].
+  --sample=<n>            Train calibration on (about) n randomly selected
+                          scores.
+  --checkpoint=<dir>      Also save output of every stage in this directory.
+  -h --help               Show this screen.
+  --version               Show version.
+
+"""
+
+from docopt import docopt
+from clustering import CompactClustering
+from matrix import save_matrix
+from metadata import Metadata
+from metrics import align, evaluate
+import DataReduction
+import cluster_distance
+import groundtruth
+import distance2probability
+import hac
+import numpy as np
+import resource
+import time
+import os
+
+
+def _reset_peak():
+    """Reset peak resident set size (Linux only)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+
+def _peak():
+    """Peak resident set size, in bytes"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profiler(object):
+    """Wall time and peak memory of successive stages
+
+    When the peak resident set size cannot be reset between stages (i.e. on
+    anything but Linux), the reported peak is the one of the whole process
+    so far.
+
+    >>> profiler = Profiler()
+    >>> with profiler('hac'):
+    ...     clustering = hac.cluster(pre_clustering, matrix, theta)
+    >>> profiler.report()
+    """
+
+    def __init__(self):
+        super(Profiler, self).__init__()
+        self.stages = []
+        self._name = None
+
+    def __call__(self, name):
+        self._name = name
+        return self
+
+    def __enter__(self):
+        _reset_peak()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.stages.append((self._name, time.time() - self._start, _peak()))
+        return False
+
+    def report(self):
+        print '{0:<16s}{1:>10s}{2:>12s}'.format('stage', 'time (s)', 'peak (MB)')
+        for name, duration, peak in self.stages:
+            print '{0:<16s}{1:>10.2f}{2:>12.1f}'.format(
+                name, duration, peak / 1024. ** 2)
+
+
+def pre_cluster(metadata, image_txt, alpha):
+    """User + time pre-clustering, as CompactClustering"""
+    clusterU = DataReduction.clusterUser(metadata, image_txt)
+    clusterD = DataReduction.clusterDate(metadata, image_txt, clusterU, alpha)
+    items, labels = [], []
+    for label, images in clusterD.iteritems():
+        items.extend(images)
+        labels.extend([label] * len(images))
+    return CompactClustering.from_arrays(items, labels)
+
+
+def do_it(image_txt, features_npy, theta, output_txt, metadata_dir,
+          alpha=86400, top=None, dtype=np.float64, reference_txt=None,
+          nbins=100, sample=None, checkpoint=None):
+
+    def save(name, save_function, data):
+        if checkpoint is not None:
+            save_function(os.path.join(checkpoint, name), data)
+
+    if checkpoint is not None and not os.path.isdir(checkpoint):
+        os.makedirs(checkpoint)
+
+    profiler = Profiler()
+
+    with profiler('pre-clustering'):
+        metadata = Metadata(metadata_dir)
+        pre_clustering = pre_cluster(metadata, image_txt, alpha)
+        save('pre_clustering.txt', lambda path, c: c.save(path),
+             pre_clustering)
+
+    with profiler('distance'):
+        with open(image_txt, 'r') as f:
+            images = [int(line.strip()) for line in f.readlines()]
+        # memory-map features (read-only)
+        features = np.load(features_npy, mmap_mode='r')
+        distance = cluster_distance.cluster_distance(
+            images, features, pre_clustering, top=top, dtype=dtype)
+        save('distance.npz' if top else 'distance.npy', save_matrix, distance)
+
+    if reference_txt is not None:
+
+        with profiler('groundtruth'):
+            reference = CompactClustering.load(reference_txt)
+            pairs = distance if top else None
+            gt = groundtruth.groundtruth_matrix(
+                reference, pre_clustering, pairs=pairs, upper=not top)
+            save('groundtruth.npz' if top else 'groundtruth.npy',
+                 save_matrix, gt)
+
+        with profiler('calibration'):
+            model = distance2probability.train(distance, gt, nbins=nbins,
+                                               sample=sample)
+            save('d2p.npz', distance2probability.save_model, model)
+            del gt
+
+            # distance = 1 - probability (in place when dense)
+            if top:
+                distance = distance2probability.apply_model(model, distance)
+                distance.data = 1. - distance.data
+            else:
+                distance = distance2probability.apply_model(
+                    model, distance, out=np.asarray(distance, dtype=np.float64))
+                np.subtract(1., distance, out=distance)
+            save('probability.npz' if top else 'probability.npy',
+                 save_matrix, distance)
+
+    with profiler('hac'):
+        clustering = hac.cluster(pre_clustering, distance, theta)
+        clustering.save(output_txt)
+
+    profiler.report()
+
+    if reference_txt is not None:
+        reference_codes, hypothesis_codes = align(
+            reference, CompactClustering(clustering))
+        results = evaluate(reference_codes, hypothesis_codes)
+        print
+        print '{0:<16s}{1:>10d}'.format('clusters', results['clusters'])
+        for name in ['homogeneity', 'completeness', 'nmi',
+                     'f1', 'divergence_f1']:
+            print '{0:<16s}{1:>10.4f}'.format(name, results[name])
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    image_txt = arguments['<image.txt>']
+    features_npy = arguments['<features.npy>']
+    theta = float(arguments['<theta>'])
+    output_txt = arguments['<output.txt>']
+    metadata_dir = arguments['--metadata']
+    alpha = int(arguments['--alpha'])
+    top = arguments['--top']
+    top = None if top is None else int(top)
+    dtype = np.dtype(arguments['--dtype'])
+    reference_txt = arguments['--reference']
+    nbins = int(arguments['--bins'])
+    sample = arguments['--sample']
+    sample = None if sample is None else int(sample)
+    checkpoint = arguments['--checkpoint']
+
+    do_it(image_txt, features_npy, theta, output_txt, metadata_dir,
+          alpha=alpha, top=top, dtype=dtype, reference_txt=reference_txt,
+          nbins=nbins, sample=sample, checkpoint=checkpoint)
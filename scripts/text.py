@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License (MIT)
+
+# Copyright (c) 2014 Hervé BREDIN
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Generate textual cosine distance matrix between clusters
+
+Each cluster is represented by a BM25-weighted vector of the words found in
+the textual metadata (title, description and tags) of its images, stored as
+a sparse CSR cluster x term matrix. Cosine similarities are obtained by a
+sparse matrix product, one block of clusters at a time.
+
+The output is either a dense K x K distance matrix (.npy, in sorted cluster
+order, like cluster_distance.py) or -- with --top -- a sparse matrix (.npz)
+only containing the distances to the k most similar clusters of each cluster
+or -- with --pairs -- a sparse matrix (.npz) only containing the distances
+between pairs stored in <pairs.npz> (e.g. candidate pairs from candidates.py).
+
+Usage:
+  text.py [--top=<k> | --pairs=<pairs.npz>] [--fields=<fields>] <metadata.dir> <clustering.txt> <output>
+  text.py (-h | --help)
+  text.py --version
+
+Options:
+  --top=<k>            Only keep the k nearest neighbours of each cluster.
+  --pairs=<pairs.npz>  Only compute distance between pairs stored in sparse matrix.
+  --fields=<fields>    Comma-separated metadata fields [default: title,description,tags].
+  -h --help            Show this screen.
+  --version            Show version.
+
+"""
+
+from docopt import docopt
+from cache import Cache
+from candidates import upper_pairs
+from clustering import CompactClustering
+from matrix import load_matrix, save_matrix
+from metadata import Metadata
+from pairwise import PAIR_BLOCK
+import scipy.sparse
+import numpy as np
+import re
+
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# number of clusters processed at once in cosine similarity computation
+BLOCK = 256
+
+STOPWORDS = set(u"""
+a an and are as at be by de for from has in is it its la le of on or that
+the this to was were will with www http https com
+""".split())
+
+TOKEN = re.compile(r'[^\W\d_]{2,}', re.UNICODE)
+
+
+def tokenize(text):
+    """Lowercase words of at least two letters (stopwords excluded)"""
+    return [token for token in TOKEN.findall(text.lower())
+            if token not in STOPWORDS]
+
+
+def term_counts(metadata, rows, codes, n_clusters,
+                fields=('title', 'description', 'tags'), vocabulary=None):
+    """Sparse cluster x term count matrix
+
+    Parameters
+    ----------
+    metadata : Metadata
+    rows : numpy array
+        Metadata rows of images.
+    codes : numpy array
+        codes[i] is the index of the cluster containing image rows[i].
+    n_clusters : int
+    fields : iterable, optional
+        Textual metadata fields.
+    vocabulary : dict, optional
+        Term to column index mapping, updated in place with new terms.
+
+    Returns
+    -------
+    counts : (n_clusters, n_terms) scipy.sparse.csr_matrix
+    vocabulary : dict
+    """
+
+    if vocabulary is None:
+        vocabulary = {}
+
+    clusters, terms = [], []
+    for field in fields:
+        for code, text in zip(codes, metadata.texts(field, rows)):
+            for token in tokenize(text):
+                clusters.append(code)
+                terms.append(vocabulary.setdefault(token, len(vocabulary)))
+
+    counts = scipy.sparse.coo_matrix(
+        (np.ones((len(terms), )), (clusters, terms)),
+        shape=(n_clusters, len(vocabulary))).tocsr()
+    return counts, vocabulary
+
+
+def bm25(counts, k1=K1, b=B):
+    """BM25-weighted and L2-normalized cluster x term matrix"""
+
+    counts = scipy.sparse.csr_matrix(counts, dtype=np.float64)
+    n_clusters, _ = counts.shape
+
+    # inverse document frequency (always positive variant)
+    df = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log(1. + (n_clusters - df + .5) / (df + .5))
+
+    # cluster length normalization
+    length = np.asarray(counts.sum(axis=1)).reshape((-1, ))
+    norm = k1 * (1. - b + b * length / max(np.mean(length), 1.))
+    norm = np.repeat(norm, np.diff(counts.indptr))
+
+    weights = counts.copy()
+    tf = counts.data
+    weights.data = idf[counts.indices] * tf * (k1 + 1.) / (tf + norm)
+
+    # L2 normalization (for later dot product)
+    squares = weights.copy()
+    squares.data **= 2
+    l2 = np.sqrt(np.asarray(squares.sum(axis=1)).reshape((-1, )))
+    l2[l2 == 0] = 1.
+    weights.data /= np.repeat(l2, np.diff(weights.indptr))
+
+    return weights
+
+
+def pair_cosine_distance(vectors, pairs, block=PAIR_BLOCK):
+    """Cosine distance between L2-normalized rows, for given pairs only
+
+    Parameters
+    ----------
+    vectors : (K, n_terms) scipy.sparse.csr_matrix
+    pairs : (K, K) scipy sparse matrix
+        Symmetric matrix whose stored entries are the pairs to compare.
+    block : int, optional
+        Number of pairs processed at once.
+
+    Returns
+    -------
+    distance : (K, K) scipy.sparse.csr_matrix
+    """
+
+    vectors = scipy.sparse.csr_matrix(vectors)
+    K = vectors.shape[0]
+    rows, cols = upper_pairs(pairs)
+
+    similarity = np.empty((len(rows), ))
+    for start in range(0, len(rows), block):
+        stop = start + block
+        product = vectors[rows[start:stop]].multiply(vectors[cols[start:stop]])
+        similarity[start:stop] = np.asarray(product.sum(axis=1)).reshape((-1, ))
+
+    # explicit construction so that zero distances are kept
+    return scipy.sparse.coo_matrix(
+        (np.hstack([1. - similarity, 1. - similarity]),
+         (np.hstack([rows, cols]), np.hstack([cols, rows]))),
+        shape=(K, K)).tocsr()
+
+
+def cosine_distance(vectors, top=None, block=BLOCK, pairs=None):
+    """Cosine distance between L2-normalized rows
+
+    Parameters
+    ----------
+    vectors : (K, n_terms) scipy.sparse.csr_matrix
+    top : int, optional
+        When provided, only keep the `top` most similar rows of each row (and
+        return a symmetric sparse matrix). Otherwise, return dense matrix.
+    block : int, optional
+        Number of rows processed at once.
+    pairs : (K, K) scipy sparse matrix, optional
+        When provided, only compute distance between pairs stored in this
+        matrix (and return a sparse matrix). See pair_cosine_distance.
+    """
+
+    if pairs is not None:
+        return pair_cosine_distance(vectors, pairs)
+
+    vectors = scipy.sparse.csr_matrix(vectors)
+    K = vectors.shape[0]
+    transposed = vectors.T.tocsr()
+
+    if top is None:
+        distance = np.empty((K, K))
+        for start in range(0, K, block):
+            stop = min(K, start + block)
+            similarity = (vectors[start:stop] * transposed).toarray()
+            distance[start:stop] = 1. - similarity
+        return distance
+
+    # a cluster is not its own neighbour
+    k = min(top, K - 1)
+
+    rows, cols, data = [], [], []
+    for start in range(0, K if k > 0 else 0, block):
+        stop = min(K, start + block)
+        similarity = (vectors[start:stop] * transposed).tocsr()
+
+        # only clusters sharing at least one term are candidate neighbours
+        for r in range(stop - start):
+            first, last = similarity.indptr[r], similarity.indptr[r + 1]
+            j = similarity.indices[first:last]
+            s = similarity.data[first:last]
+            keep = (j != start + r) & (s > 0)
+            j, s = j[keep], s[keep]
+            if len(s) > k:
+                best = np.argpartition(-s, k - 1)[:k]
+                j, s = j[best], s[best]
+            rows.append(np.repeat(start + r, len(j)))
+            cols.append(j)
+            data.append(s)
+
+    if rows:
+        rows, cols, data = np.hstack(rows), np.hstack(cols), np.hstack(data)
+    similarity = scipy.sparse.coo_matrix((data, (rows, cols)), shape=(K, K))
+
+    # symmetrize (i is among j's top neighbours or the other way around)
+    similarity = similarity.tocsr().maximum(similarity.T.tocsr()).tocoo()
+
+    # explicit construction so that zero distances are kept
+    return scipy.sparse.coo_matrix(
+        (1. - similarity.data, (similarity.row, similarity.col)),
+        shape=(K, K)).tocsr()
+
+
+def do_it(metadata_dir, clustering_txt, output, top=None,
+          fields=('title', 'description', 'tags'), pairs_npz=None):
+
+    metadata = Metadata(metadata_dir)
+
+    # load hypothesis clusters
+    clustering = CompactClustering.load(clustering_txt)
+    clusters = sorted(clustering.clusters)
+
+    # cluster index of every image
+    index = {cluster: c for c, cluster in enumerate(clusters)}
+    images = list(clustering)
+    codes = [index[c] for c in clustering.to_list(images)]
+
+    counts, _ = term_counts(metadata, metadata.index(images), codes,
+                            len(clusters), fields=fields)
+    pairs = None if pairs_npz is None else load_matrix(pairs_npz)
+    distance = cosine_distance(bm25(counts), top=top, pairs=pairs)
+
+    save_matrix(output, distance)
+
+
+if __name__ == '__main__':
+
+    arguments = docopt(__doc__, version='0.1')
+
+    metadata_dir = arguments['<metadata.dir>']
+    clustering_txt = arguments['<clustering.txt>']
+    output = arguments['<output>']
+    top = arguments['--top']
+    top = None if top is None else int(top)
+    fields = arguments['--fields'].split(',')
+    pairs_npz = arguments['--pairs']
+
+    Cache().run(__file__, [metadata_dir, clustering_txt, pairs_npz],
+                {'top': top, 'fields': fields}, [output],
+                do_it, metadata_dir, clustering_txt, output,
+                top=top, fields=fields, pairs_npz=pairs_npz)